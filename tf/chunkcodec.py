@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+#
+#    This file is part of Leela Chess.
+#
+#    Leela Chess is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Leela Chess is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Leela Chess.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import glob
+import gzindex
+import gzip
+import numpy as np
+import os
+import random
+import shutil
+import tempfile
+import time
+import unittest
+from v3format import V3_BYTES, ChunkTestCase, synthetic_chunk, write_chunks
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Chunk file extensions, by codec.
+EXTENSIONS = ['.gz', '.zst']
+# The zstd dictionary of the .zst chunks in the same directory.
+DICT_NAME = 'v3.zdict'
+# zstd dictionaries loaded so far, by filename.
+_dictionaries = {}
+
+def dictionary(dirname):
+    """
+        Return the zstd dictionary of the chunks in 'dirname', or None if
+        they were compressed without one.
+    """
+    filename = os.path.join(dirname, DICT_NAME)
+    if filename not in _dictionaries:
+        if os.path.exists(filename):
+            with open(filename, 'rb') as f:
+                _dictionaries[filename] = zstandard.ZstdCompressionDict(f.read())
+        else:
+            _dictionaries[filename] = None
+    return _dictionaries[filename]
+
+
+def read_chunk(filename, sample=1):
+    """
+        Return the chunkdata of chunk 'filename', with the codec of its
+        extension, keeping each v3 record with a chance of 1 in 'sample'.
+    """
+    if not filename.endswith('.zst'):
+        return gzindex.read_chunk(filename, sample)
+    with open(filename, 'rb') as f:
+        raw = f.read()
+    zdict = dictionary(os.path.dirname(filename))
+    if zdict is None:
+        data = zstandard.ZstdDecompressor().decompress(raw)
+    else:
+        data = zstandard.ZstdDecompressor(dict_data=zdict).decompress(raw)
+    return data if sample == 1 else gzindex.sample_records(data, sample)
+
+
+def train_dictionary(chunks, size=112640, records=2000):
+    """
+        Train a zstd dictionary of 'size' bytes on up to 'records' v3
+        records taken from the chunks 'chunks'.
+    """
+    samples = []
+    per_chunk = max(1, records // max(1, len(chunks)))
+    for chunk in chunks:
+        data = read_chunk(chunk)
+        count = len(data) // V3_BYTES
+        for i in random.sample(range(count), min(count, per_chunk)):
+            samples.append(data[i * V3_BYTES:(i + 1) * V3_BYTES])
+    return zstandard.train_dictionary(size, samples)
+
+
+def reencode(chunks, output, level=3, dict_size=112640, train_chunks=200):
+    """
+        Write the chunks 'chunks' to the directory 'output' as .zst chunks,
+        compressed with a dictionary trained on 'train_chunks' of them,
+        saved there as DICT_NAME. The chunks keep their modification times,
+        which the training window is chosen by. Returns the new filenames.
+    """
+    os.makedirs(output, exist_ok=True)
+    zdict = train_dictionary(random.sample(chunks, min(len(chunks), train_chunks)), dict_size)
+    with open(os.path.join(output, DICT_NAME), 'wb') as f:
+        f.write(zdict.as_bytes())
+    _dictionaries.pop(os.path.join(output, DICT_NAME), None)
+    compressor = zstandard.ZstdCompressor(level=level, dict_data=zdict)
+    filenames = []
+    for chunk in chunks:
+        try:
+            data = read_chunk(chunk)
+        except:
+            print("failed to parse {}".format(chunk))
+            continue
+        name = os.path.basename(chunk)
+        for ext in EXTENSIONS:
+            if name.endswith(ext):
+                name = name[:-len(ext)]
+        filename = os.path.join(output, name + '.zst')
+        with open(filename + '.tmp', 'wb') as f:
+            f.write(compressor.compress(data))
+        os.replace(filename + '.tmp', filename)
+        stat = os.stat(chunk)
+        os.utime(filename, (stat.st_atime, stat.st_mtime))
+        filenames.append(filename)
+    return filenames
+
+
+def benchmark(chunks, level=3, dict_size=112640, repeat=3):
+    """
+        Print the compression ratio and decompression speed of the gzipped
+        chunks 'chunks' against zstd with and without a dictionary trained
+        on them.
+    """
+    data = [read_chunk(c) for c in chunks]
+    total = sum(len(d) for d in data)
+    zdict = train_dictionary(chunks, dict_size)
+    codecs = [
+        ('gzip', lambda d: gzip.compress(d), gzip.decompress),
+        ('zstd', zstandard.ZstdCompressor(level=level).compress,
+            zstandard.ZstdDecompressor().decompress),
+        ('zstd+dict', zstandard.ZstdCompressor(level=level, dict_data=zdict).compress,
+            zstandard.ZstdDecompressor(dict_data=zdict).decompress),
+    ]
+    for name, compress, decompress in codecs:
+        packed = [compress(d) for d in data]
+        start = time.time()
+        for _ in range(repeat):
+            for p in packed:
+                decompress(p)
+        elapsed = time.time() - start
+        print("{:10s} ratio {:5.1f}  decompress {:7.1f} MB/s".format(
+            name, total / sum(len(p) for p in packed), repeat * total / elapsed / 1e6))
+
+
+def main(args):
+    if args.synthetic:
+        rng = np.random.default_rng(0)
+        tmp = tempfile.mkdtemp()
+        chunks = write_chunks(tmp, [synthetic_chunk(rng, rng.integers(40, 160))
+                                    for _ in range(args.synthetic)])
+        benchmark(chunks, args.level, args.dict_size)
+        shutil.rmtree(tmp)
+        return
+    chunks = []
+    for pattern in args.files:
+        chunks += glob.glob(pattern)
+    if args.benchmark:
+        benchmark(chunks, args.level, args.dict_size)
+    if args.output:
+        filenames = reencode(chunks, args.output, args.level, args.dict_size)
+        print("Wrote {} chunks to {}".format(len(filenames), args.output))
+
+
+@unittest.skipIf(zstandard is None, "needs zstandard")
+class ChunkCodecTest(ChunkTestCase):
+    def setUp(self):
+        super().setUp()
+        self.data = [synthetic_chunk(self.rng, 30) for _ in range(20)]
+        self.chunks = self.write_chunks(self.data)
+    def test_reencode(self):
+        output = os.path.join(self.dir, 'zst')
+        filenames = reencode(self.chunks, output, dict_size=16384)
+        assert os.path.exists(os.path.join(output, DICT_NAME))
+        assert [os.path.basename(f) for f in filenames] == \
+            ['training.{}.zst'.format(i) for i in range(20)]
+        for chunk, filename, data in zip(self.chunks, filenames, self.data):
+            assert read_chunk(filename) == data
+            assert os.path.getmtime(filename) == os.path.getmtime(chunk)
+        sampled = read_chunk(filenames[0], sample=4)
+        assert len(sampled) % V3_BYTES == 0 and len(sampled) < len(self.data[0])
+
+
+if __name__ == '__main__':
+    usage_str = """
+Re-encode gzipped chunks as zstd chunks with a dictionary trained on them,
+or compare the codecs on chunks or on synthetic games."""
+
+    parser = argparse.ArgumentParser(
+            formatter_class=argparse.RawDescriptionHelpFormatter,
+            description=usage_str)
+    parser.add_argument("files", type=str, nargs="*",
+            help="training*.gz, globs allowed")
+    parser.add_argument("--output", type=str,
+            help="directory to write the zstd chunks and their dictionary to")
+    parser.add_argument("--level", type=int, default=3,
+            help="zstd compression level")
+    parser.add_argument("--dict-size", type=int, default=112640,
+            help="size of the zstd dictionary")
+    parser.add_argument("--benchmark", action="store_true",
+            help="compare gzip and zstd on the chunks")
+    parser.add_argument("--synthetic", type=int, default=0,
+            help="compare gzip and zstd on this many synthetic games instead")
+    main(parser.parse_args())
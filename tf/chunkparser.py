@@ -18,16 +18,39 @@
 #    along with Leela Chess.  If not, see <http://www.gnu.org/licenses/>.
 
 import itertools
+import json
 import multiprocessing as mp
 import numpy as np
+import os
+import queue
 import random
 import shufflebuffer as sb
+from compactrecords import CompactRecords
+from shufflestats import ShuffleStats
+from v3format import VERSION, STRUCT_STRING, V3_BYTES, V3_DTYPE, PROBS, PLANES, SCALARS
+from workerpool import WorkerPool
 import struct
-import tensorflow as tf
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
 
-VERSION = struct.pack('i', 3)
-STRUCT_STRING = '4s7432s832sBBBBBBBb'
+# Items queued between two pipeline stages.
+STAGE_QUEUE = 2
+# Marks the end of the items of a pipeline stage.
+STAGE_END = object()
+
+class _NoLock:
+    """
+    A context manager doing nothing, in place of a lock nobody else takes.
+    """
+    def __enter__(self):
+        return self
+    def __exit__(self, *args):
+        return False
+
 
 # Interface for a chunk data source.
 class ChunkDataSrc:
@@ -39,11 +62,15 @@ class ChunkDataSrc:
         return self.items.pop()
 
 
-
 class ChunkParser:
     # static batch size
     BATCH_SIZE = 8
-    def __init__(self, chunkdatasrc, shuffle_size=1, sample=1, buffer_size=1, batch_size=256, workers=None):
+    def __init__(self, chunkdatasrc, shuffle_size=1, sample=1, buffer_size=1, batch_size=256, workers=None,
+                 frame_records=1, frame_bytes=None, transport='pipe', ring_slots=64,
+                 worker_batches=False, packed_planes=False, shuffle_dir=None,
+                 compact_records=False, policy_slots=64, shuffle_warmup=None, state=None,
+                 shuffle_stats=False, worker_shuffle_size=None, pool=None, weight=1.0,
+                 max_restarts=100, batch_arrays=False, batch_slots=8, pipeline_stages=False):
         """
         Read data and yield batches of raw tensors.
 
@@ -51,6 +78,58 @@ class ChunkParser:
         'shuffle_size' is the size of the shuffle buffer.
         'sample' is the rate to down-sample.
         'workers' is the number of child workers to use.
+        'frame_records' is the number of v3 records a worker packs into a
+        single message to the parent.
+        'frame_bytes' if set, overrides 'frame_records' with as many records
+        as fit into a message of that many bytes.
+        'transport' is how frames get from the workers to the parent, either
+        'pipe' for an mp.Pipe or 'shm' for a shared memory ring per worker.
+        'ring_slots' is the number of messages each shared memory ring holds.
+        'worker_batches' if set, makes every worker shuffle its share of the
+        shuffle buffer and send whole decoded batches, leaving the parent
+        to only forward them.
+        'packed_planes' if set, yields batches with the bit planes still
+        packed and the scalar planes as raw bytes, to be expanded on the
+        graph by parse_function_packed.
+        'shuffle_dir' if set, is a directory on fast local storage or
+        hugetlbfs in which the shuffle buffers are kept as mapped files.
+        'compact_records' if set, keeps the records in the shuffle buffers
+        in the compact encoding of CompactRecords, with room for
+        'policy_slots' non-zero policy entries, so the same memory holds
+        several times as many records.
+        'shuffle_warmup' if set, is the fraction of the shuffle buffer that
+        must be filled before records are yielded. Records are then yielded
+        at a rate ramping up as the buffer fills, instead of only once it's
+        full.
+        'state' if set, is the prefix of the files written by save_state()
+        to resume the data source and the shuffle buffer from.
+        'shuffle_stats' if set, tags every record with the chunk it comes
+        from, to measure how well the shuffle buffer decorrelates the
+        records it yields, see shuffle_quality(). Has no effect with
+        'worker_batches'.
+        'worker_shuffle_size' if set, gives every worker a shuffle buffer of
+        its own of that many records, which the records go through before
+        being sent to the parent. The parent's shuffle buffer can then be
+        smaller for the same decorrelation. With 'worker_batches' it
+        overrides the worker's share of 'shuffle_size'.
+        'pool' if set, is a WorkerPool to run this parser as a stream of,
+        with share 'weight' of the workers. 'workers' and 'transport' are
+        then the pool's. The pool must be started once all its parsers are
+        created. Otherwise the parser runs a pool of its own of 'workers'
+        workers, with this parser as its only stream.
+        'max_restarts' is the number of times workers that die are replaced
+        by new ones, before they are left dead, for a pool of its own.
+        'batch_arrays' if set, yields batches as float32 NumPy arrays shaped
+        like the tensors parse_function returns, so they can go to tf.data
+        without parse_function. Records are decoded straight into a ring of
+        'batch_slots' preallocated batches, so a batch is overwritten
+        'batch_slots' batches later, and 'batch_slots' must exceed the
+        batches tf.data holds on to. Can't be used with 'packed_planes'.
+        'pipeline_stages' if set, runs reading from the workers, shuffling,
+        batching and decoding in the parent as stages in threads of their
+        own, connected by queues of STAGE_QUEUE items, so waiting on pipes
+        and NumPy work overlap. The time every stage spends busy and idle
+        is counted, see get_stats(). Has no effect with 'worker_batches'.
 
         The data is represented in a number of formats through this dataflow
         pipeline. In order, they are:
@@ -60,10 +139,18 @@ class ChunkParser:
         chunkdata: type Bytes. Multiple records of v3 format where each record
         consists of (state, policy, result)
 
+        frame: One or more v3 records concatenated together. This is used to
+        pass data from the workers to the parent, so the pipe and the parent
+        only pay the per-message cost once for 'frame_records' records.
+
         raw: A byte string holding raw tensors contenated together. This is
-        used to pass data from the workers to the parent. Exists because
-        TensorFlow doesn't have a fast way to unpack bit vectors. 7950 bytes
-        long.
+        used to pass data from the workers to the parent when
+        'worker_batches' is set. Exists because TensorFlow doesn't have a
+        fast way to unpack bit vectors. 36108 bytes long.
+
+        packed: A byte string holding packed bit planes, probs and the 8
+        scalar bytes of a record, as batches yielded with 'packed_planes'.
+        8272 bytes long.
         """
 
         # Build 2 flat float32 planes with values 0,1
@@ -77,35 +164,137 @@ class ChunkParser:
         self.batch_size = batch_size
         # set number of elements in the shuffle buffer.
         self.shuffle_size = shuffle_size
+        # set where to keep file backed shuffle buffers.
+        self.shuffle_dir = shuffle_dir
+        # set whether records carry the id of their chunk, 8 bytes long.
+        self.shuffle_stats = shuffle_stats and not worker_batches
+        self.tag_size = 8 if self.shuffle_stats else 0
+        # set whether shuffle buffers hold compact records.
+        self.compact_records = compact_records
+        self.policy_slots = policy_slots
+        # set the fill fraction from which shuffle buffers yield records.
+        self.shuffle_warmup = shuffle_warmup
+        # set the number of records sent to the parent per message.
+        if frame_bytes:
+            frame_records = frame_bytes // (struct.calcsize(STRUCT_STRING) + self.tag_size)
+        self.frame_records = max(1, frame_records)
+        assert transport in ('pipe', 'shm'), transport
+        self.transport = transport
+        self.ring_slots = ring_slots
         # Start worker processes, leave 2 for TensorFlow
-        if workers is None:
+        self.pool = pool
+        if pool is not None:
+            workers = pool.workers
+        elif workers is None:
             workers = max(1, mp.cpu_count() - 2)
+        # set whether workers decode batches, each with a slice of the
+        # shuffle buffer.
+        self.worker_batches = worker_batches
+        if worker_shuffle_size is None and worker_batches:
+            worker_shuffle_size = max(1, shuffle_size // workers)
+        # set the size of the shuffle buffer in every worker.
+        self.worker_shuffle_size = worker_shuffle_size
+        # set whether batches hold packed planes for on-graph expansion.
+        self.packed_planes = packed_planes
+        # set whether batches are yielded as arrays from a ring of batches.
+        assert not (batch_arrays and packed_planes)
+        self.batch_arrays = batch_arrays
+        self.batch_slots = batch_slots
 
         print("Using {} worker processes.".format(workers))
 
-        # Start the child workers running
-        self.readers = []
-        self.writers = []
-        self.processes = []
-        for _ in range(workers):
-            read, write = mp.Pipe(duplex=False)
-            p = mp.Process(target=self.task, args=(chunkdatasrc, write))
-            self.processes.append(p)
-            p.start()
-            self.readers.append(read)
-            self.writers.append(write)
+        self.init_stats()
+        self.pipeline_stages = pipeline_stages
+
+        # Resume the data source before the workers get a copy of it.
+        self.chunkdatasrc = chunkdatasrc
+        self.state = state
+        self.saved_state = {}
+        if state is not None and os.path.exists(state + '.json'):
+            with open(state + '.json') as f:
+                self.saved_state = json.load(f)
+            if 'datasrc' in self.saved_state:
+                chunkdatasrc.set_state(self.saved_state['datasrc'])
+
+        # Run as a stream of the pool, or of a pool of its own.
+        self.own_pool = pool is None
+        if self.own_pool:
+            self.pool = WorkerPool(workers, transport=transport, ring_slots=ring_slots,
+                    max_restarts=max_restarts)
+        self.stream = self.pool.add_stream(self, chunkdatasrc, weight)
         self.init_structs()
 
+        # The parent's shuffle buffer and codec, guarded for save_state().
+        self.shuffle = None
+        self.shuffle_lock = threading.Lock()
+        self.shuffle_analyzer = None
+        if self.shuffle_stats:
+            self.shuffle_analyzer = ShuffleStats(batch_size, horizon=4 * shuffle_size)
+
+        # Start the child workers running
+        if self.own_pool:
+            self.pool.start()
+
+
+    def message_size(self):
+        """
+        Return the size in bytes of the largest message from a worker.
+        """
+        if self.worker_batches and self.packed_planes:
+            # The probs are the largest of the three batch messages.
+            return self.batch_size * 1858 * 4
+        elif self.worker_batches:
+            # The planes are the largest of the three batch messages.
+            return self.batch_size * 112 * 8 * 8 * 4
+        return self.frame_records * (struct.calcsize(STRUCT_STRING) + self.tag_size)
+
+
+    def message_list_size(self):
+        """
+        Return the size in bytes of the largest list of messages from a
+        worker.
+        """
+        if self.worker_batches and self.packed_planes:
+            # Everything but the version, with the planes still packed.
+            return self.batch_size * (struct.calcsize(STRUCT_STRING) - 4)
+        elif self.worker_batches:
+            return ChunkParser.batch_bytes(self.batch_size)
+        return self.message_size()
+
+
+    @staticmethod
+    def batch_bytes(batch_size):
+        """
+        Return the size in bytes of the unpacked tensors of a batch of
+        'batch_size' records, as parse_function returns them.
+        """
+        return batch_size * (112 * 8 * 8 + 1858 + 1) * 4
+
 
     def shutdown(self):
         """
-        Terminates all the workers
+        Terminates all the workers and releases the shuffle buffers
+        """
+        if self.own_pool:
+            self.pool.shutdown()
+        for sbuff in self.shuffle_buffers:
+            sbuff.close()
+
+
+    def init_stats(self):
+        """
+        Start the input pipeline counters, see get_stats(), and the shuffle
+        buffers they are kept for, afresh. A worker keeps its own.
         """
-        for i in range(len(self.readers)):
-            self.processes[i].terminate()
-            self.processes[i].join()
-            self.readers[i].close()
-            self.writers[i].close()
+        self.shuffle_buffers = []
+        self.stats = {
+            'shuffle_fill': 0.0,
+            'warmup_time': None,
+            'fill_time': None,
+            'stages': {},
+        }
+        # Stage times at the last stage_report().
+        self.last_stages = {}
 
 
     def init_structs(self):
@@ -134,6 +323,8 @@ class ChunkParser:
         """
         Convert unpacked record batches to tensors for tensorflow training
         """
+        # Only imported here, so that the workers never load TensorFlow.
+        import tensorflow as tf
         planes = tf.decode_raw(planes, tf.float32)
         probs = tf.decode_raw(probs, tf.float32)
         winner = tf.decode_raw(winner, tf.float32)
@@ -145,6 +336,54 @@ class ChunkParser:
         return (planes, probs, winner)
 
 
+    @staticmethod
+    def parse_function_packed(planes, probs, scalars):
+        """
+        Convert packed record batches to tensors for tensorflow training,
+        unpacking the bit planes and broadcasting the scalar planes on the
+        graph.
+        """
+        import tensorflow as tf
+        planes = tf.decode_raw(planes, tf.uint8)
+        probs = tf.decode_raw(probs, tf.float32)
+        scalars = tf.decode_raw(scalars, tf.uint8)
+        return ChunkParser.expand_packed(planes, probs, scalars)
+
+
+    @staticmethod
+    def expand_packed(planes, probs, scalars):
+        """
+        Expand tensors of the packed planes and scalar bytes as uint8 and
+        the policy as float32 of a batch of records to the tensors
+        parse_function returns.
+        """
+        import tensorflow as tf
+        # Unpack bit planes, most significant bit first like np.unpackbits.
+        planes = tf.reshape(tf.cast(planes, tf.int32), (ChunkParser.BATCH_SIZE, 104*8, 1))
+        bits = tf.constant([128, 64, 32, 16, 8, 4, 2, 1], dtype=tf.int32)
+        planes = tf.floormod(tf.floordiv(planes, bits), 2)
+        planes = tf.reshape(tf.cast(planes, tf.float32), (ChunkParser.BATCH_SIZE, 104, 8*8))
+
+        # The scalar bytes are castling us_ooo, us_oo, them_ooo, them_oo,
+        # side_to_move, rule50_count, move_count and result.
+        scalars = tf.reshape(scalars, (ChunkParser.BATCH_SIZE, 8))
+        winner = tf.cast(tf.bitcast(scalars[:, 7:8], tf.int8), tf.float32)
+        scalars = tf.cast(scalars, tf.float32)
+        # Enforce move_count to 0, and make the last plane all 1's so the NN
+        # can detect edges of the board more easily
+        scalars = tf.concat([scalars[:, 0:5],
+                             scalars[:, 5:6] / 99,
+                             tf.zeros_like(scalars[:, 6:7]),
+                             tf.ones_like(scalars[:, 7:8])], axis=1)
+        scalars = tf.tile(tf.reshape(scalars, (ChunkParser.BATCH_SIZE, 8, 1)), (1, 1, 8*8))
+        planes = tf.concat([planes, scalars], axis=1)
+
+        probs = tf.reshape(probs, (ChunkParser.BATCH_SIZE, 1858))
+        winner = tf.reshape(winner, (ChunkParser.BATCH_SIZE, 1))
+
+        return (planes, probs, winner)
+
+
     def convert_v3_to_tuple(self, content):
         """
         Unpack a v3 binary record to 3-tuple (state, policy pi, result)
@@ -190,61 +429,392 @@ class ChunkParser:
         return (planes, probs, winner)
 
 
-    def sample_record(self, chunkdata):
+    @staticmethod
+    def convert_v3_batch(records):
+        """
+        Unpack a batch of concatenated v3 records to a 3-tuple of raw tensor
+        batches (state, policy pi, result).
+
+        This is the vectorized equivalent of joining convert_v3_to_tuple over
+        every record, producing the exact same bytes.
         """
-        Randomly sample through the v3 chunk data and select records
+        n = memoryview(records).nbytes // V3_BYTES
+        planes = np.empty((n, 112, 8*8), dtype=np.float32)
+        probs = np.empty((n, 1858), dtype=np.float32)
+        winner = np.empty((n, 1), dtype=np.float32)
+        ChunkParser.decode_v3_batch(records, planes, probs, winner)
+        return (planes.tobytes(), probs.tobytes(), winner.tobytes())
+
+
+    @staticmethod
+    def decode_v3_batch(records, planes, probs, winner):
+        """
+        Decode a batch of concatenated v3 records into the float32 arrays
+        'planes', 'probs' and 'winner', of shapes (n, 112, 64), (n, 1858)
+        and (n, 1) for n records.
+        """
+        data = np.frombuffer(records, dtype=V3_DTYPE)
+        n = len(data)
+
+        # Unpack bit planes and cast to 32 bit float
+        planes[:, :104] = np.unpackbits(data['planes'], axis=1).reshape(n, 104, 8*8)
+        for i, name in enumerate(('us_ooo', 'us_oo', 'them_ooo', 'them_oo', 'stm')):
+            planes[:, 104 + i] = data[name][:, None]
+        planes[:, 109] = (data['rule50_count'].astype(np.float32) / 99)[:, None]
+        # Enforce move_count to 0
+        planes[:, 110] = 0
+        # Make the last plane all 1's so the NN can detect edges of the board
+        # more easily
+        planes[:, 111] = 1
+
+        # The policy is float32 already, so copy its bytes as they are.
+        probs.view(np.uint8)[:] = data['probs']
+        winner[:, 0] = data['winner']
+        assert np.all(np.abs(winner) <= 1.0)
+
+
+    @staticmethod
+    def pack_v3_batch(records):
+        """
+        Split a batch of concatenated v3 records into a 3-tuple of packed
+        tensor batches (packed planes, policy pi, scalars) for
+        parse_function_packed.
+        """
+        data = np.frombuffer(records, dtype=np.uint8).reshape(-1, V3_BYTES)
+        return (data[:, PLANES].tobytes(), data[:, PROBS].tobytes(), data[:, SCALARS].tobytes())
+
+
+    def convert_batch(self, records):
+        """
+        Convert a batch of concatenated v3 records to the output format.
+        """
+        if self.packed_planes:
+            return self.pack_v3_batch(records)
+        return self.convert_v3_batch(records)
+
+
+    def sample_record(self, chunkdata, sample):
+        """
+        Randomly sample through the v3 chunk data and select records,
+        1 in 'sample' of them.
         """
         if chunkdata[0:4] == VERSION:
             for i in range(0, len(chunkdata), self.v3_struct.size):
-                if self.sample > 1:
+                if sample > 1:
                     # Downsample, using only 1/Nth of the items.
-                    if random.randint(0, self.sample-1) != 0:
+                    if random.randint(0, sample-1) != 0:
                         continue  # Skip this record.
                 yield chunkdata[i:i+self.v3_struct.size]
 
 
-    def task(self, chunkdatasrc, writer):
+    def record_gen(self, chunkdatasrc):
         """
-        Run in fork'ed process, read data from chunkdatasrc, parsing, shuffling and
-        sending v3 data through pipe back to main process.
+        Read chunkdata from chunkdatasrc and yield sampled v3 records.
+
+        With 'shuffle_stats', every record is followed by the id of its
+        chunk, unique across the workers. A data source with next_sampled()
+        is left to sample the records itself.
         """
-        self.init_structs()
+        chunk = os.getpid() << 32
+        tag = b''
         while True:
-            chunkdata = chunkdatasrc.next()
+            sample = self.sample
+            if hasattr(chunkdatasrc, 'next_sampled'):
+                # The data source only reads the records it samples.
+                chunkdata = chunkdatasrc.next_sampled(sample)
+                sample = 1
+            else:
+                chunkdata = chunkdatasrc.next()
             if chunkdata is None:
-                break
-            for item in self.sample_record(chunkdata):
+                return
+            chunk += 1
+            if self.shuffle_stats:
+                tag = struct.pack('<Q', chunk)
+            for item in self.sample_record(chunkdata, sample):
                 # NOTE: This requires some more thinking, we can't just apply a
                 # reflection along the horizontal or vertical axes as we would
                 # also have to apply the reflection to the move probabilities
                 # which is non trivial for chess.
-                writer.send_bytes(item)
+                yield item + tag
 
 
-    def v3_gen(self):
+    def frame_gen(self, gen):
+        """
+        Pack v3 records into frames of 'frame_records' records.
         """
-        Read v3 records from child workers, shuffle, and yield
-        records.
-        """
-        sbuff = sb.ShuffleBuffer(self.v3_struct.size, self.shuffle_size)
-        while len(self.readers):
-            #for r in mp.connection.wait(self.readers):
-            for r in self.readers:
-                try:
-                    s = r.recv_bytes()
-                    s = sbuff.insert_or_replace(s)
-                    if s is None:
-                        continue  # shuffle buffer not yet full
-                    yield s
-                except EOFError:
-                    print("Reader EOF")
-                    self.readers.remove(r)
-        # drain the shuffle buffer.
         while True:
-            s = sbuff.extract()
-            if s is None:
+            s = list(itertools.islice(gen, self.frame_records))
+            if not len(s):
                 return
-            yield s
+            yield b''.join(s)
+
+
+    def shuffle_gen(self, gen, shuffle_size, persist=False):
+        """
+        Shuffle frames of v3 records through a shuffle buffer of
+        'shuffle_size' records, and yield the displaced records as 2-D
+        arrays with one record per row. The shuffle buffer is drained once
+        'gen' is exhausted.
+
+        If 'persist' is set, the shuffle buffer is the one saved by
+        save_state(), and is resumed from 'state'.
+        """
+        min_fill = None
+        if self.shuffle_warmup is not None:
+            min_fill = int(self.shuffle_warmup * shuffle_size)
+        if self.compact_records:
+            codec = CompactRecords(self.policy_slots)
+            size = codec.size
+        else:
+            codec = None
+            size = self.v3_struct.size
+        sbuff = sb.ShuffleBuffer(size + self.tag_size, shuffle_size, path=self.shuffle_dir, min_fill=min_fill)
+        self.shuffle_buffers.append(sbuff)
+        lock = _NoLock()
+        if persist:
+            lock = self.shuffle_lock
+            self.shuffle = (sbuff, codec)
+            self.restore_shuffle(sbuff, codec)
+        start = time.time()
+        try:
+            for frame in gen:
+                with lock:
+                    s = sbuff.insert_or_replace_many(self.shuffle_pack(frame, codec))
+                    s = self.shuffle_unpack(s, codec)
+                self.report_fill(sbuff, len(s), start)
+                if not len(s):
+                    continue  # shuffle buffer not yet full
+                yield s
+            # drain the shuffle buffer.
+            with lock:
+                s = self.shuffle_unpack(sbuff.extract_many(sbuff.used), codec)
+            if len(s):
+                yield s
+        finally:
+            with lock:
+                sbuff.close()
+
+
+    def shuffle_pack(self, frame, codec):
+        """
+        Convert a frame to the records held in the shuffle buffer.
+        """
+        if not self.tag_size:
+            return codec.compact(frame) if codec else frame
+        rows = np.frombuffer(frame, dtype=np.uint8).reshape(-1, self.v3_struct.size + self.tag_size)
+        records = rows[:, :-self.tag_size]
+        if codec:
+            records = codec.compact(np.ascontiguousarray(records))
+        return np.hstack([records, rows[:, -self.tag_size:]])
+
+
+    def shuffle_unpack(self, s, codec):
+        """
+        Convert records taken out of the shuffle buffer back to v3 records,
+        accounting for their chunks with 'shuffle_stats'.
+        """
+        if not len(s):
+            return s
+        if self.tag_size:
+            tags = np.ascontiguousarray(s[:, -self.tag_size:])
+            self.shuffle_analyzer.add(tags.view('<u8').ravel())
+            s = np.ascontiguousarray(s[:, :-self.tag_size])
+        return codec.expand(s) if codec else s
+
+
+    def shuffle_quality(self):
+        """
+        Return how well the shuffle buffer decorrelated the records it
+        yielded since the last call, see ShuffleStats.report(). Empty
+        without 'shuffle_stats'.
+        """
+        if self.shuffle_analyzer is None:
+            return {}
+        with self.shuffle_lock:
+            return self.shuffle_analyzer.report()
+
+
+    def restore_shuffle(self, sbuff, codec):
+        """
+        Load the records saved by save_state() into shuffle buffer 'sbuff'.
+        """
+        saved = self.saved_state.get('shuffle')
+        if not saved:
+            return
+        if saved['elem_size'] != sbuff.elem_size:
+            print("Not restoring the shuffle buffer, its record size changed")
+            return
+        count = sbuff.load(self.state + '.shuffle')
+        if codec:
+            codec.set_state(saved['codec'])
+        print("Restored {} records into the shuffle buffer".format(count))
+
+
+    def save_state(self, prefix):
+        """
+        Save the position of the data source and the contents of the
+        parent's shuffle buffer, to resume from with 'state' set to 'prefix'.
+
+        Writes 'prefix'.json, and the records of the shuffle buffer as raw
+        rows to 'prefix'.shuffle. Records already taken out of the shuffle
+        buffer, or still on their way from the workers, are not saved. With
+        'worker_batches' the shuffle buffers are in the workers, so only
+        the data source is saved.
+        """
+        state = {}
+        if hasattr(self.chunkdatasrc, 'get_state'):
+            state['datasrc'] = self.chunkdatasrc.get_state()
+        with self.shuffle_lock:
+            if self.shuffle is not None and self.shuffle[0].buffer is not None:
+                sbuff, codec = self.shuffle
+                sbuff.save(prefix + '.shuffle.tmp')
+                os.replace(prefix + '.shuffle.tmp', prefix + '.shuffle')
+                state['shuffle'] = {'elem_size': sbuff.elem_size, 'used': sbuff.used}
+                if codec:
+                    state['shuffle']['codec'] = codec.get_state()
+        with open(prefix + '.json.tmp', 'w') as f:
+            json.dump(state, f)
+        os.replace(prefix + '.json.tmp', prefix + '.json')
+
+
+    def report_fill(self, sbuff, count, start):
+        """
+        Record the fill level of shuffle buffer 'sbuff' after it returned
+        'count' records, and how long it took to start returning records and
+        to fill up since 'start'.
+        """
+        self.stats['shuffle_fill'] = sbuff.used / sbuff.elem_count
+        if count and self.stats['warmup_time'] is None:
+            self.stats['warmup_time'] = time.time() - start
+            print("Shuffle buffer warm after {:.1f}s, {:.0%} full".format(
+                self.stats['warmup_time'], self.stats['shuffle_fill']))
+        if sbuff.used == sbuff.elem_count and self.stats['fill_time'] is None:
+            self.stats['fill_time'] = time.time() - start
+            print("Shuffle buffer full after {:.1f}s".format(self.stats['fill_time']))
+
+
+    def __getstate__(self):
+        # The parent's lock, pool, shuffle buffers and counters stay behind
+        # when sent to a worker, also a replacement started once they are
+        # filled, and the structs are rebuilt by init_structs() there.
+        state = dict(self.__dict__)
+        for k in ('shuffle_lock', 'pool', 'v3_struct', 'shuffle_buffers', 'shuffle',
+                  'shuffle_analyzer', 'saved_state', 'stats', 'last_stages'):
+            state.pop(k, None)
+        return state
+
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.shuffle = None
+        self.shuffle_analyzer = None
+        self.saved_state = {}
+        self.init_stats()
+
+
+    def worker_gen(self, chunkdatasrc):
+        """
+        Read data from chunkdatasrc in a worker, and yield lists of messages
+        for the parent.
+
+        Records are sent in frames of 'frame_records' records to amortize the
+        cost of a pipe message over many records. With 'worker_batches' the
+        worker shuffles and decodes batches itself, and sends each batch as
+        three messages: planes, probs and winner. Otherwise, records go
+        through a shuffle buffer of 'worker_shuffle_size' records if set.
+        """
+        self.init_structs()
+        gen = self.record_gen(chunkdatasrc)
+        gen = self.frame_gen(gen)
+        if self.worker_batches:
+            gen = self.shuffle_gen(gen, self.worker_shuffle_size)
+            for batch in self.v3_batch_gen(gen):
+                yield list(batch)
+        else:
+            if self.worker_shuffle_size:
+                gen = self.preshuffle_gen(gen)
+            for frame in gen:
+                yield [frame]
+
+
+    def preshuffle_gen(self, gen):
+        """
+        Shuffle frames through a worker's own shuffle buffer of
+        'worker_shuffle_size' records, and yield the displaced records as
+        frames again, of at most 'frame_records' records.
+        """
+        min_fill = None
+        if self.shuffle_warmup is not None:
+            min_fill = int(self.shuffle_warmup * self.worker_shuffle_size)
+        sbuff = sb.ShuffleBuffer(self.v3_struct.size + self.tag_size, self.worker_shuffle_size,
+                path=self.shuffle_dir, min_fill=min_fill)
+        try:
+            for frame in gen:
+                s = sbuff.insert_or_replace_many(frame)
+                if len(s):
+                    yield s.tobytes()
+            # drain the shuffle buffer.
+            while sbuff.used:
+                yield sbuff.extract_many(self.frame_records).tobytes()
+        finally:
+            sbuff.close()
+
+
+    def recv_gen(self):
+        """
+        Yield the lists of messages of this parser's stream of the pool, as
+        produced by worker_gen() in the workers.
+        """
+        yield from self.pool.stream_gen(self.stream)
+
+
+    def v3_gen(self):
+        """
+        Read frames of v3 records from child workers, shuffle, and yield
+        records as 2-D arrays with one record per row.
+        """
+        gen = (frame for frame, in self.recv_gen())
+        return self.shuffle_gen(gen, self.shuffle_size, persist=True)
+
+
+    def get_stats(self):
+        """
+        Return a snapshot of the input pipeline counters.
+
+        'wait_time' is the time in seconds the parent was blocked with no
+        message of its stream ready.
+        'hol_skips', 'worker_messages', 'restarts' and 'workers' are the
+        pool's, see WorkerPool.get_stats(), shared with other parsers of the
+        pool.
+        'shuffle_fill' is the fraction of the shuffle buffer in use.
+        'warmup_time' is the time in seconds the shuffle buffer took to
+        yield its first records, or None if it hasn't yet.
+        'fill_time' is the time in seconds the shuffle buffer took to fill
+        up, or None if it isn't full yet.
+        'stages' has the time in seconds every pipeline stage spent busy,
+        starved for input, blocked on a full queue, and that the next stage
+        spent waiting on it ('drained'), with 'pipeline_stages'.
+        The shuffle buffer counters stay unset with 'worker_batches', as
+        the shuffle buffers are in the workers then.
+        """
+        stats = dict(self.stats)
+        pool_stats = self.pool.get_stats()
+        stats['wait_time'] = pool_stats['stream_wait_time'][self.stream]
+        for k in ('hol_skips', 'worker_messages', 'restarts', 'workers'):
+            stats[k] = pool_stats[k]
+        stats['stages'] = {k: dict(v) for k, v in stats['stages'].items()}
+        return stats
+
+
+    def pipeline_report(self):
+        """
+        Return the counters of get_stats() that are set and single numbers,
+        for the training reports.
+        """
+        stats = self.get_stats()
+        keys = ('shuffle_fill', 'warmup_time', 'fill_time', 'wait_time', 'hol_skips', 'restarts',
+                'workers')
+        return {k: stats[k] for k in keys if stats[k] is not None}
 
 
     def tuple_gen(self, gen):
@@ -271,18 +841,233 @@ class ChunkParser:
                     b''.join([x[2] for x in s]) )
 
 
+    def record_batch_gen(self, gen):
+        """
+        Pack 2-D arrays of v3 records into 2-D arrays of a batch of records.
+        """
+        pending = []
+        count = 0
+        for s in gen:
+            pending.append(s)
+            count += len(s)
+            while count >= self.batch_size:
+                s = np.concatenate(pending)
+                yield s[:self.batch_size]
+                pending = [s[self.batch_size:]]
+                count -= self.batch_size
+        if count:
+            yield np.concatenate(pending)
+
+
+    def v3_batch_gen(self, gen):
+        """
+        Pack 2-D arrays of v3 records into batches and convert each batch to
+        tuples in one go.
+        """
+        for s in self.record_batch_gen(gen):
+            yield self.convert_batch(s)
+
+
+    def array_batch_gen(self, gen):
+        """
+        Decode 2-D arrays of v3 records straight into a ring of
+        preallocated batches of float32 arrays, and yield the full ones.
+        """
+        slots = self.batch_slots
+        if self.pipeline_stages:
+            # Also the batches queued after the decode stage and the one
+            # it's waiting to queue.
+            slots += STAGE_QUEUE + 1
+        ring = [(np.empty((self.batch_size, 112, 8*8), dtype=np.float32),
+                 np.empty((self.batch_size, 1858), dtype=np.float32),
+                 np.empty((self.batch_size, 1), dtype=np.float32))
+                for _ in range(slots)]
+        slot = 0
+        count = 0
+        for s in gen:
+            while len(s):
+                n = min(len(s), self.batch_size - count)
+                self.decode_v3_batch(s[:n], *(a[count:count + n] for a in ring[slot]))
+                s = s[n:]
+                count += n
+                if count == self.batch_size:
+                    yield ring[slot]
+                    slot = (slot + 1) % len(ring)
+                    count = 0
+        if count:
+            yield tuple(a[:count] for a in ring[slot])
+
+
+    def raw_gen(self):
+        """
+        Read batches of raw tensors decoded by the child workers.
+        """
+        for planes, probs, winner in self.recv_gen():
+            if self.batch_arrays:
+                # Views of the messages, which nothing else holds on to.
+                planes = np.frombuffer(planes, dtype=np.float32).reshape(-1, 112, 8*8)
+                probs = np.frombuffer(probs, dtype=np.float32).reshape(-1, 1858)
+                winner = np.frombuffer(winner, dtype=np.float32).reshape(-1, 1)
+            yield (planes, probs, winner)
+
+
+    def stage_gen(self, name, gen, waited):
+        """
+        Run generator 'gen' as pipeline stage 'name' in a thread of its own,
+        and yield its items through a queue.
+
+        'waited' returns the time in seconds 'gen' spent waiting for its
+        input so far, which counts as the stage being starved rather than
+        busy. The time the stage is blocked on a full queue is counted too.
+        """
+        times = {'busy': 0.0, 'starved': 0.0, 'blocked': 0.0, 'drained': 0.0}
+        self.stats['stages'][name] = times
+        q = queue.Queue(STAGE_QUEUE)
+
+        def run():
+            try:
+                while True:
+                    before = waited()
+                    start = time.time()
+                    item = next(gen, STAGE_END)
+                    starved = waited() - before
+                    end = time.time()
+                    times['starved'] += starved
+                    times['busy'] += end - start - starved
+                    q.put(item)
+                    times['blocked'] += time.time() - end
+                    if item is STAGE_END:
+                        return
+            except Exception as e:
+                q.put(e)
+
+        def drain():
+            while True:
+                start = time.time()
+                item = q.get()
+                # The time the next stage waits on this one.
+                times['drained'] += time.time() - start
+                if item is STAGE_END:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+
+        threading.Thread(target=run, name=name, daemon=True).start()
+        return drain()
+
+
+    def staged_gen(self):
+        """
+        Read data from child workers, shuffle, batch and decode, each as a
+        pipeline stage, and yield batches of unpacked records.
+        """
+        def read_waited():
+            return self.pool.stats['stream_wait_time'][self.stream]
+        stages = self.stats['stages']
+        gen = (frame for frame, in self.recv_gen())
+        gen = self.stage_gen('read', gen, read_waited)
+        gen = self.shuffle_gen(gen, self.shuffle_size, persist=True)
+        gen = self.stage_gen('shuffle', gen, lambda: stages['read']['drained'])
+        if self.batch_arrays:
+            # Batching and decoding are one, as records are decoded straight
+            # into their batch.
+            gen = self.array_batch_gen(gen)
+        else:
+            gen = self.record_batch_gen(gen)
+            gen = self.stage_gen('batch', gen, lambda: stages['shuffle']['drained'])
+            gen = (self.convert_batch(s) for s in gen)
+        upstream = 'shuffle' if self.batch_arrays else 'batch'
+        return self.stage_gen('decode', gen, lambda: stages[upstream]['drained'])
+
+
+    def stage_report(self):
+        """
+        Return the fraction of the time every pipeline stage was busy and
+        idle since the last report, and start over.
+        """
+        report = {}
+        for name, times in self.stats['stages'].items():
+            times = dict(times)
+            last = self.last_stages.get(name, {})
+            delta = {k: v - last.get(k, 0.0) for k, v in times.items()}
+            total = delta['busy'] + delta['starved'] + delta['blocked']
+            if total > 0:
+                report[name + '_busy'] = delta['busy'] / total
+                report[name + '_idle'] = (delta['starved'] + delta['blocked']) / total
+            self.last_stages[name] = times
+        return report
+
+
     def parse(self):
         """
         Read data from child workers and yield batches of unpacked records
         """
-        gen = self.v3_gen()        # read from workers
-        gen = self.tuple_gen(gen)  # convert v3->tuple
-        gen = self.batch_gen(gen)  # assemble into batches
+        if self.worker_batches:
+            gen = self.raw_gen()          # read batches from workers
+        elif self.pipeline_stages:
+            gen = self.staged_gen()       # read, shuffle, batch and decode in threads
+        else:
+            gen = self.v3_gen()           # read from workers
+            if self.batch_arrays:
+                gen = self.array_batch_gen(gen)  # decode into a ring of batches
+            else:
+                gen = self.v3_batch_gen(gen)  # assemble into batches of tuples
         for b in gen:
             yield b
 
 
 
+class StalledDataSrc(ChunkDataSrc):
+    """
+    A chunk data source where the first worker to read gets stuck forever.
+    """
+    def __init__(self, items):
+        super().__init__(items)
+        self.stalled = mp.Value('b', 0)
+    def next(self):
+        with self.stalled.get_lock():
+            stall = not self.stalled.value
+            self.stalled.value = 1
+        while stall:
+            time.sleep(1)
+        return super().next()
+
+
+class CrashingDataSrc(ChunkDataSrc):
+    """
+    A chunk data source that kills the worker reading it, the first
+    'crashes' times it's read from after the first 'after' reads by any
+    worker.
+    """
+    def __init__(self, items, crashes=1, after=0):
+        super().__init__(items)
+        self.crashes = mp.Value('i', crashes)
+        self.reads = mp.Value('i', 0)
+        self.after = after
+    def next(self):
+        with self.crashes.get_lock():
+            self.reads.value += 1
+            crash = self.reads.value > self.after and self.crashes.value > 0
+            if crash:
+                self.crashes.value -= 1
+        if crash:
+            os._exit(1)
+        return super().next()
+
+
+class SlowDataSrc(ChunkDataSrc):
+    """
+    A chunk data source taking 'delay' seconds per read.
+    """
+    def __init__(self, items, delay):
+        super().__init__(items)
+        self.delay = delay
+    def next(self):
+        time.sleep(self.delay)
+        return super().next()
+
+
 # Tests to check that records parse correctly
 class ChunkParserTest(unittest.TestCase):
     def setUp(self):
@@ -359,10 +1144,415 @@ class ChunkParserTest(unittest.TestCase):
         parser.shutdown()
 
 
+    def test_batch_decoding(self):
+        """
+        Test that batch decoding yields the planes, probs and winner of
+        every record.
+        """
+        truths = [self.generate_fake_pos() for i in range(16)]
+        records = [self.v3_record(*truth) for truth in truths]
+        data = ChunkParser.convert_v3_batch(b''.join(records))
+        planes = np.frombuffer(data[0], dtype=np.float32).reshape(16, 112, 64)
+        probs = np.frombuffer(data[1], dtype=np.int32).reshape(16, 1858)
+        winner = np.frombuffer(data[2], dtype=np.float32).reshape(16, 1)
+        for i, truth in enumerate(truths):
+            fltplanes = truth[1].astype(np.float32)
+            fltplanes[5] /= 99
+            fltplanes = np.append(fltplanes, 1)
+            self.assertTrue((planes[i][:104] == truth[0]).all())
+            self.assertTrue((planes[i][104:] == fltplanes[:, None]).all())
+            self.assertTrue((probs[i] == truth[2]).all())
+            self.assertEqual(winner[i][0], truth[3])
+
+
+    def test_batch_arrays(self):
+        """
+        Test that batches decoded into the ring match batch decoding, also
+        across frames split between batches.
+        """
+        records = [self.v3_record(*self.generate_fake_pos()) for i in range(10)]
+        parser = ChunkParser(ChunkDataSrc([b''.join(records)]), shuffle_size=1, workers=1,
+                batch_size=4, batch_arrays=True, batch_slots=2, frame_records=3)
+        batches = []
+        out = []
+        for b in parser.parse():
+            batches.append(b)
+            out.append(tuple(a.copy() for a in b))
+        parser.shutdown()
+        self.assertEqual([len(b[0]) for b in out], [4, 4, 2])
+        left = [ChunkParser.convert_v3_batch(r) for r in records]
+        for b in out:
+            for row in range(len(b[0])):
+                decoded = tuple(a[row].tobytes() for a in b)
+                self.assertIn(decoded, left)
+                left.remove(decoded)
+        self.assertEqual(left, [])
+        # The third batch reuses the first batch's arrays.
+        self.assertTrue(np.shares_memory(batches[0][0], batches[2][0]))
+
+
+    def test_pipeline_stages(self):
+        """
+        Test that the pipeline stages yield the same batches, and count
+        their time.
+        """
+        truth = self.generate_fake_pos()
+        batch_size = 4
+        record = self.v3_record(*truth)
+        expected = None
+        for batch_arrays in (False, True):
+            parser = ChunkParser(ChunkDataSrc([record * (3 * batch_size)]), shuffle_size=1, workers=1,
+                    batch_size=batch_size, batch_arrays=batch_arrays, pipeline_stages=True)
+            batches = list(parser.parse())
+            self.assertEqual(len(batches), 3)
+            if expected is None:
+                expected = parser.convert_v3_batch(record * batch_size)
+            for data in batches:
+                for i in range(3):
+                    self.assertEqual(bytes(data[i]), expected[i])
+            stages = parser.get_stats()['stages']
+            names = ['read', 'shuffle', 'decode'] if batch_arrays else ['read', 'shuffle', 'batch', 'decode']
+            self.assertEqual(sorted(stages), sorted(names))
+            for times in stages.values():
+                self.assertTrue(times['busy'] > 0, times)
+            report = parser.stage_report()
+            self.assertAlmostEqual(report['decode_busy'] + report['decode_idle'], 1.0)
+            parser.shutdown()
+
+
+    def test_framing(self):
+        """
+        Test that records sent in frames arrive intact and complete.
+        """
+        chunks = []
+        for i in range(5):
+            chunks.append(b''.join([self.v3_record(*self.generate_fake_pos()) for j in range(i + 1)]))
+        records = [c[i:i+self.v3_struct.size] for c in chunks for i in range(0, len(c), self.v3_struct.size)]
+
+        for transport in ('pipe', 'shm'):
+            parser = ChunkParser(ChunkDataSrc(list(chunks)), shuffle_size=1, workers=1,
+                    frame_records=4, transport=transport, ring_slots=2)
+            # The shuffle buffer holds back one record.
+            gen = (r.tobytes() for s in parser.v3_gen() for r in s)
+            out = list(itertools.islice(gen, len(records) - 1))
+            self.assertEqual(len(out), len(records) - 1)
+            left = list(records)
+            for r in out:
+                left.remove(r)
+            self.assertEqual(len(left), 1)
+            parser.shutdown()
+
+
+    def test_worker_batches(self):
+        """
+        Test that batches decoded by the workers match decoding in the parent.
+        """
+        truth = self.generate_fake_pos()
+        batch_size = 4
+        record = self.v3_record(*truth)
+        expected = None
+        for transport in ('pipe', 'shm'):
+            parser = ChunkParser(ChunkDataSrc([record * batch_size]), shuffle_size=2, workers=1,
+                    batch_size=batch_size, transport=transport, worker_batches=True)
+            data = next(parser.parse())
+            if expected is None:
+                expected = parser.convert_v3_batch(record * batch_size)
+            for i in range(3):
+                self.assertEqual(data[i], expected[i])
+            parser.shutdown()
+
+
+    def test_packed_parsing(self):
+        """
+        Test that packed batches hold the planes, probs and scalar bytes.
+        """
+        truth = self.generate_fake_pos()
+        batch_size = 4
+        record = self.v3_record(*truth)
+        # The shuffle buffer holds back one record.
+        parser = ChunkParser(ChunkDataSrc([record * (batch_size + 1)]), shuffle_size=1, workers=1,
+                batch_size=batch_size, packed_planes=True)
+        data = next(parser.parse())
+        planes = np.unpackbits(np.frombuffer(data[0], dtype=np.uint8)).reshape(batch_size, 104, 64)
+        probs = np.frombuffer(data[1], dtype=np.int32).reshape(batch_size, 1858)
+        scalars = np.frombuffer(data[2], dtype=np.uint8).reshape(batch_size, 8)
+        for i in range(batch_size):
+            self.assertTrue((planes[i] == truth[0]).all())
+            self.assertTrue((probs[i] == truth[2]).all())
+            self.assertTrue((scalars[i][:7] == truth[1]).all())
+            self.assertEqual(scalars[i].view(np.int8)[7], truth[3])
+        parser.shutdown()
+
+
+    def test_tensorflow_packed_parsing(self):
+        """
+        Test that expanding packed batches on the graph matches the host.
+        """
+        import tensorflow as tf
+        batch_size = 4
+        ChunkParser.BATCH_SIZE = batch_size
+        records = b''.join([self.v3_record(*self.generate_fake_pos()) for i in range(batch_size)])
+
+        data = ChunkParser.convert_v3_batch(records)
+        packed = ChunkParser.pack_v3_batch(records)
+
+        planes = np.frombuffer(data[0], dtype=np.float32).reshape(batch_size, 112, 8*8)
+        probs = np.frombuffer(data[1], dtype=np.float32).reshape(batch_size, 1858)
+        winner = np.frombuffer(data[2], dtype=np.float32).reshape(batch_size, 1)
+
+        # Pass it through tensorflow
+        with tf.Session() as sess:
+            graph = ChunkParser.parse_function_packed(packed[0], packed[1], packed[2])
+            tf_planes, tf_probs, tf_winner = sess.run(graph)
+
+            self.assertTrue((planes == tf_planes).all())
+            self.assertTrue((probs.view(np.int32) == tf_probs.view(np.int32)).all())
+            self.assertTrue((winner == tf_winner).all())
+
+
+    def test_shuffle_dir(self):
+        """
+        Test that a file backed shuffle buffer is released on shutdown.
+        """
+        records = [self.v3_record(*self.generate_fake_pos()) for i in range(8)]
+        with tempfile.TemporaryDirectory() as path:
+            parser = ChunkParser(ChunkDataSrc(list(records)), shuffle_size=4, workers=1,
+                    batch_size=4, shuffle_dir=path)
+            data = next(parser.parse())
+            self.assertEqual(len(data[2]), 4 * 4)
+            self.assertEqual(os.listdir(path), [])
+            parser.shutdown()
+            self.assertTrue(all(b.buffer is None for b in parser.shuffle_buffers))
+
+
+    def test_compact_records(self):
+        """
+        Test that records come out of a compact shuffle buffer unchanged.
+        """
+        records = [self.v3_record(*self.generate_fake_pos()) for i in range(8)]
+        # Leave some of the records sparse enough to fit the policy slots.
+        for i in range(0, 8, 2):
+            r = bytearray(records[i])
+            r[4 + 4 * 8:7436] = bytes(7436 - 4 - 4 * 8)
+            records[i] = bytes(r)
+        parser = ChunkParser(ChunkDataSrc(list(records)), shuffle_size=4, workers=1,
+                compact_records=True, policy_slots=8)
+        # The shuffle buffer holds back 4 records.
+        gen = (r.tobytes() for s in parser.v3_gen() for r in s)
+        left = list(records)
+        for r in itertools.islice(gen, 4):
+            left.remove(r)
+        self.assertEqual(len(left), 4)
+        parser.shutdown()
+
+
+    def test_shuffle_warmup(self):
+        """
+        Test that a warming shuffle buffer yields before it's full.
+        """
+        # Too few records to ever fill the shuffle buffer.
+        records = [self.v3_record(*self.generate_fake_pos()) for i in range(95)]
+        parser = ChunkParser(ChunkDataSrc(list(records)), shuffle_size=100, workers=1,
+                shuffle_warmup=0.1)
+        gen = (r.tobytes() for s in parser.v3_gen() for r in s)
+        out = next(gen)
+        self.assertIn(out, records)
+        stats = parser.get_stats()
+        self.assertIsNotNone(stats['warmup_time'])
+        self.assertIsNone(stats['fill_time'])
+        self.assertLess(stats['shuffle_fill'], 0.95)
+        report = parser.pipeline_report()
+        self.assertEqual(set(report), {'shuffle_fill', 'warmup_time', 'wait_time', 'hol_skips',
+                'restarts', 'workers'})
+        self.assertEqual(report['workers'], 1)
+        parser.shutdown()
+
+
+    def test_save_state(self):
+        """
+        Test that a resumed parser continues with the saved shuffle buffer.
+        """
+        records = [self.v3_record(*self.generate_fake_pos()) for i in range(8)]
+        for compact in (False, True):
+            parser = ChunkParser(ChunkDataSrc(list(records)), shuffle_size=4, workers=1,
+                    compact_records=compact)
+            gen = (r.tobytes() for s in parser.v3_gen() for r in s)
+            out = list(itertools.islice(gen, 2))
+            with tempfile.TemporaryDirectory() as path:
+                prefix = os.path.join(path, 'state')
+                parser.save_state(prefix)
+                parser.shutdown()
+                resumed = ChunkParser(ChunkDataSrc([]), shuffle_size=4, workers=1,
+                        compact_records=compact, state=prefix)
+                # No new frames, so the shuffle buffer is drained right away.
+                gen = resumed.shuffle_gen(iter([]), 4, persist=True)
+                held = [r.tobytes() for s in gen for r in s]
+                resumed.shutdown()
+            # The records held in the shuffle buffer come out after a restart.
+            self.assertEqual(len(held), 4)
+            self.assertTrue(all(r in records and r not in out for r in held))
+
+
+    def test_worker_preshuffle(self):
+        """
+        Test that records pass intact through the workers' shuffle buffers.
+        """
+        records = [self.v3_record(*self.generate_fake_pos()) for i in range(12)]
+        for transport in ('pipe', 'shm'):
+            parser = ChunkParser(ChunkDataSrc(list(records)), shuffle_size=1, workers=1,
+                    frame_records=2, transport=transport, worker_shuffle_size=4)
+            # The worker's shuffle buffer holds back 4 records, the parent's 1.
+            gen = (r.tobytes() for s in parser.v3_gen() for r in s)
+            out = list(itertools.islice(gen, 7))
+            left = list(records)
+            for r in out:
+                left.remove(r)
+            self.assertEqual(len(left), 5)
+            parser.shutdown()
+
+
+    def test_shuffle_stats(self):
+        """
+        Test that chunk tags are measured and stripped from the records.
+        """
+        chunks = []
+        for i in range(4):
+            chunks.append(b''.join([self.v3_record(*self.generate_fake_pos()) for j in range(4)]))
+        records = [c[i:i+self.v3_struct.size] for c in chunks for i in range(0, len(c), self.v3_struct.size)]
+        for compact in (False, True):
+            parser = ChunkParser(ChunkDataSrc(list(chunks)), shuffle_size=4, workers=1,
+                    batch_size=2, frame_records=3, compact_records=compact, shuffle_stats=True)
+            gen = (r.tobytes() for s in parser.v3_gen() for r in s)
+            out = list(itertools.islice(gen, 12))
+            self.assertTrue(all(r in records for r in out))
+            quality = parser.shuffle_quality()
+            self.assertEqual(set(quality), {'same_chunk_pairs', 'chunks_per_batch', 'sibling_distance'})
+            self.assertTrue(1 <= quality['chunks_per_batch'] <= 2)
+            self.assertGreaterEqual(quality['sibling_distance'], 1)
+            parser.shutdown()
+
+
+    def test_pool(self):
+        """
+        Test that two parsers sharing a pool each get their own records.
+        """
+        train = [self.v3_record(*self.generate_fake_pos()) for i in range(8)]
+        test = [self.v3_record(*self.generate_fake_pos()) for i in range(8)]
+        pool = WorkerPool(workers=2)
+        train_parser = ChunkParser(ChunkDataSrc(list(train)), shuffle_size=1, pool=pool, weight=4)
+        test_parser = ChunkParser(ChunkDataSrc(list(test)), shuffle_size=1, pool=pool, worker_batches=True,
+                batch_size=2)
+        pool.start()
+        # Both workers read the whole of their copy of the data sources.
+        out = [r.tobytes() for s in train_parser.v3_gen() for r in s]
+        self.assertEqual(sorted(out), sorted(train * 2))
+        batches = list(test_parser.parse())
+        self.assertEqual(len(batches), 8)
+        pool.shutdown()
+        train_parser.shutdown()
+        test_parser.shutdown()
+
+
+    def test_no_tensorflow(self):
+        """
+        Test that the modules a worker needs don't import TensorFlow.
+        """
+        check = "import sys, chunkparser, datasrc, workerpool; sys.exit('tensorflow' in sys.modules)"
+        subprocess.check_call([sys.executable, '-c', check],
+                cwd=os.path.dirname(os.path.abspath(__file__)))
+
+
+    def test_worker_restart(self):
+        """
+        Test that a worker that dies is replaced.
+        """
+        records = [self.v3_record(*self.generate_fake_pos()) for i in range(4)]
+        for transport in ('pipe', 'shm'):
+            parser = ChunkParser(CrashingDataSrc(list(records)), shuffle_size=1, workers=2,
+                    transport=transport)
+            out = [r.tobytes() for s in parser.v3_gen() for r in s]
+            # The replacement reads all the records again, like the other worker.
+            self.assertEqual(sorted(out), sorted(records * 2))
+            self.assertEqual(parser.get_stats()['restarts'], 1)
+            parser.shutdown()
+
+
+    def test_restart_after_shuffle(self):
+        """
+        Test that a worker replaced once the parent's shuffle buffer is
+        filled gets none of it, also with a file backed shuffle buffer.
+        """
+        records = [self.v3_record(*self.generate_fake_pos()) for i in range(20)]
+        # Workers are spawned in training, which pickles the parser.
+        method = mp.get_start_method()
+        mp.set_start_method('spawn', force=True)
+        try:
+            with tempfile.TemporaryDirectory() as path:
+                for shuffle_dir in (None, path):
+                    # The parent reads all but the 2 messages the stream has
+                    # credit for before the worker crashes on its 11th read.
+                    parser = ChunkParser(CrashingDataSrc(list(records), after=10), shuffle_size=4,
+                            workers=1, shuffle_dir=shuffle_dir)
+                    out = [r.tobytes() for s in parser.v3_gen() for r in s]
+                    # The replacement reads all the records again.
+                    self.assertEqual(sorted(out), sorted(records[10:] + records))
+                    self.assertEqual(parser.get_stats()['restarts'], 1)
+                    parser.shutdown()
+        finally:
+            mp.set_start_method(method, force=True)
+
+
+    def test_autoscale(self):
+        """
+        Test that workers added to the pool of a running parser get none of
+        the parent's shuffle buffer, also a file backed one.
+        """
+        record = self.v3_record(*self.generate_fake_pos())
+        method = mp.get_start_method()
+        mp.set_start_method('spawn', force=True)
+        try:
+            with tempfile.TemporaryDirectory() as path:
+                pool = WorkerPool(workers=1, min_workers=1, max_workers=2, scale_interval=0.2)
+                parser = ChunkParser(SlowDataSrc([record] * 10000, 0.02), shuffle_size=4, pool=pool,
+                        shuffle_dir=path)
+                pool.start()
+                gen = (r for s in parser.v3_gen() for r in s)
+                # Reading as fast as possible leaves the parser waiting on
+                # one worker, so a second one is added.
+                start = time.time()
+                while time.time() - start < 3.0:
+                    next(gen)
+                stats = pool.get_stats()
+                pool.shutdown()
+                parser.shutdown()
+        finally:
+            mp.set_start_method(method, force=True)
+        self.assertEqual(stats['workers'], 2)
+        self.assertEqual(stats['scale_ups'], 1)
+        self.assertTrue(all(stats['worker_messages']), stats)
+
+
+    def test_stalled_worker(self):
+        """
+        Test that a stuck worker doesn't stall the other workers.
+        """
+        record = self.v3_record(*self.generate_fake_pos())
+        parser = ChunkParser(StalledDataSrc([record] * 8), shuffle_size=1, workers=2)
+        gen = (r for s in parser.v3_gen() for r in s)
+        out = list(itertools.islice(gen, 7))
+        self.assertEqual(len(out), 7)
+        stats = parser.get_stats()
+        # The stuck worker sent nothing, the other all it was let.
+        self.assertEqual(min(stats['worker_messages']), 0)
+        self.assertGreaterEqual(max(stats['worker_messages']), 7)
+        parser.shutdown()
+
+
     def test_tensorflow_parsing(self):
         """
         Test game position decoding pipeline including tensorflow.
         """
+        import tensorflow as tf
         truth = self.generate_fake_pos()
         batch_size = 4
         ChunkParser.BATCH_SIZE = batch_size
@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+#
+#    This file is part of Leela Chess.
+#
+#    Leela Chess is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Leela Chess is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Leela Chess.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import chunkcodec
+import collections.abc
+import glob
+import mmap
+import numpy as np
+import os
+import struct
+import unittest
+import zlib
+from datasrc import FileDataSrc
+from v3format import VERSION, V3_BYTES, ChunkTestCase, synthetic_chunk
+
+MAGIC = b'LCSH'
+FORMAT = 1
+# magic, format, record size, records per block, zlib level (0 for
+# uncompressed blocks), games, records, blocks, offset of the index.
+HEADER = struct.Struct('<4sIIIIQQQQ')
+HEADER_BYTES = 64
+
+def write_chunk_shard(chunks, filename, block_records=4, level=1):
+    """
+        Pack the v3 records of the chunk files 'chunks' into the chunk
+        shard 'filename', one game per chunk. Returns the number of
+        games written.
+
+        A chunk shard is a header of HEADER_BYTES bytes, the records in
+        blocks of 'block_records' records, and an index: the first record
+        of every game and the file offset of every block, as uint64, each
+        with an extra entry marking the end. With 'level', every block is
+        compressed with zlib on its own, so that a record is read by
+        decompressing just its block. Records are fixed size, so the
+        offset of a record within its block follows from its index.
+    """
+    game_starts = [0]
+    block_offsets = [HEADER_BYTES]
+    pending = []
+    with open(filename + '.tmp', 'wb') as f:
+        f.write(bytes(HEADER_BYTES))
+
+        def flush(n):
+            block = b''.join(pending[:n])
+            del pending[:n]
+            if level:
+                block = zlib.compress(block, level)
+            f.write(block)
+            block_offsets.append(block_offsets[-1] + len(block))
+
+        for chunk in chunks:
+            try:
+                data = chunkcodec.read_chunk(chunk)
+            except:
+                print("failed to parse {}".format(chunk))
+                continue
+            if data[0:4] != VERSION:
+                print("skipping {}, not v3".format(chunk))
+                continue
+            count = len(data) // V3_BYTES
+            pending += [data[i * V3_BYTES:(i + 1) * V3_BYTES] for i in range(count)]
+            game_starts.append(game_starts[-1] + count)
+            while len(pending) >= block_records:
+                flush(block_records)
+        if pending:
+            flush(len(pending))
+        index_offset = block_offsets[-1]
+        f.write(np.array(game_starts, dtype='<u8').tobytes())
+        f.write(np.array(block_offsets, dtype='<u8').tobytes())
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, FORMAT, V3_BYTES, block_records, level,
+            len(game_starts) - 1, game_starts[-1], len(block_offsets) - 1, index_offset))
+    os.replace(filename + '.tmp', filename)
+    return len(game_starts) - 1
+
+
+def read_header(f):
+    """
+        Read the header of the chunk shard open as 'f', returning it as a
+        dict.
+    """
+    magic, fmt, record_size, block_records, level, games, records, blocks, index_offset = \
+        HEADER.unpack(f.read(HEADER.size))
+    if magic != MAGIC or fmt != FORMAT:
+        raise ValueError("not a chunk shard")
+    return {'record_size': record_size, 'block_records': block_records, 'level': level,
+            'games': games, 'records': records, 'blocks': blocks, 'index_offset': index_offset}
+
+
+class ChunkShard:
+    def __init__(self, filename):
+        """
+            Reads the records of a chunk shard written by write_chunk_shard()
+            through a read-only mapping of the file, so only the pages of
+            the records read, or of their blocks, are ever loaded.
+        """
+        with open(filename, 'rb') as f:
+            self.header = read_header(f)
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.record_size = self.header['record_size']
+        self.block_records = self.header['block_records']
+        self.level = self.header['level']
+        self.games = self.header['games']
+        offset = self.header['index_offset']
+        self.game_starts = np.frombuffer(self.mmap[offset:offset + 8 * (self.games + 1)], dtype='<u8')
+        offset += 8 * (self.games + 1)
+        self.block_offsets = np.frombuffer(self.mmap[offset:offset + 8 * (self.header['blocks'] + 1)], dtype='<u8')
+        # The last decompressed block, as (block, data).
+        self.cached = (None, None)
+
+    def block(self, b):
+        """
+            Return the records of block 'b', decompressed.
+        """
+        if self.cached[0] != b:
+            data = self.mmap[self.block_offsets[b]:self.block_offsets[b + 1]]
+            self.cached = (b, zlib.decompress(data))
+        return self.cached[1]
+
+    def records(self, indices):
+        """
+            Return the records at the sorted 'indices' concatenated. Only
+            the blocks holding them are decompressed.
+        """
+        size = self.record_size
+        out = []
+        for i in indices:
+            b, r = divmod(int(i), self.block_records)
+            if self.level:
+                out.append(self.block(b)[r * size:(r + 1) * size])
+            else:
+                start = int(self.block_offsets[b]) + r * size
+                out.append(self.mmap[start:start + size])
+        return b''.join(out)
+
+    def game(self, game, sample=1):
+        """
+            Return the records of 'game' concatenated, keeping each with a
+            chance of 1 in 'sample'.
+        """
+        start, end = int(self.game_starts[game]), int(self.game_starts[game + 1])
+        indices = np.arange(start, end)
+        if sample > 1:
+            indices = indices[np.random.randint(sample, size=len(indices)) == 0]
+        return self.records(indices)
+
+    def close(self):
+        self.mmap.close()
+
+
+class _Games(collections.abc.Sequence):
+    """
+        The games of a list of chunk shards, named 'shard#game' like the
+        chunk filenames of a FileDataSrc, without building every name.
+    """
+    def __init__(self, shards, games):
+        self.shards = shards
+        self.ends = np.cumsum(games)
+
+    def __len__(self):
+        return int(self.ends[-1]) if len(self.ends) else 0
+
+    def __getitem__(self, i):
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        s = int(np.searchsorted(self.ends, i, side='right'))
+        first = int(self.ends[s - 1]) if s else 0
+        return '{}#{}'.format(self.shards[s], i - first)
+
+
+class ChunkShardDataSrc(FileDataSrc):
+    """
+        data source yielding chunkdata from the games of chunk shards.
+
+        Works like FileDataSrc with every game as a chunk. Only the headers
+        of the shards are read up front.
+    """
+    def __init__(self, shards, seed=None):
+        games = []
+        for filename in shards:
+            with open(filename, 'rb') as f:
+                games.append(read_header(f)['games'])
+        super().__init__(_Games(shards, games), seed)
+        # Shards mapped by this worker, by filename.
+        self.open_shards = {}
+
+    def read(self, name):
+        filename, game = name.rsplit('#', 1)
+        if filename not in self.open_shards:
+            self.open_shards[filename] = ChunkShard(filename)
+        return self.open_shards[filename].game(int(game), self.sample)
+
+    def __getstate__(self):
+        # Mappings are made again by every worker.
+        state = dict(self.__dict__)
+        state['open_shards'] = {}
+        return state
+
+
+def main(args):
+    chunks = []
+    for pattern in args.files:
+        chunks += glob.glob(pattern)
+    chunks.sort()
+    filenames = []
+    for i in range(0, len(chunks), args.games):
+        filename = '{}-{:05d}.shard'.format(args.output, len(filenames))
+        write_chunk_shard(chunks[i:i + args.games], filename, args.block_records, args.level)
+        filenames.append(filename)
+    print("Packed {} chunks into {} shards".format(len(chunks), len(filenames)))
+
+
+class ChunkShardTest(ChunkTestCase):
+    def setUp(self):
+        super().setUp()
+        self.games = [synthetic_chunk(self.rng, 3 + 7 * i) for i in range(6)]
+        self.chunks = self.write_chunks(self.games)
+    def test_games(self):
+        for level in (0, 1):
+            filename = os.path.join(self.dir, 'test.shard')
+            assert write_chunk_shard(self.chunks, filename, block_records=8, level=level) == 6
+            shard = ChunkShard(filename)
+            for i, data in enumerate(self.games):
+                assert shard.game(i) == data
+            # Sampling reads whole records of the game.
+            sampled = shard.game(5, sample=4)
+            assert len(sampled) % V3_BYTES == 0 and len(sampled) < len(self.games[5])
+            assert all(sampled[i:i + V3_BYTES] in self.games[5]
+                       for i in range(0, len(sampled), V3_BYTES))
+            shard.close()
+    def test_compressed_blocks(self):
+        filename = os.path.join(self.dir, 'test.shard')
+        write_chunk_shard(self.chunks, filename, block_records=8, level=1)
+        shard = ChunkShard(filename)
+        decompressed = []
+        block = shard.block
+        shard.block = lambda b: decompressed.append(b) or block(b)
+        # Record 26 is in block 3, the only block decompressed.
+        shard.records([26])
+        assert decompressed == [3], decompressed
+        shard.close()
+    @unittest.skipIf(chunkcodec.zstandard is None, "needs zstandard")
+    def test_zst(self):
+        chunks = chunkcodec.reencode(self.chunks, os.path.join(self.dir, 'zst'), dict_size=4096)
+        filename = os.path.join(self.dir, 'test.shard')
+        assert write_chunk_shard(chunks, filename) == 6
+        shard = ChunkShard(filename)
+        assert [shard.game(i) for i in range(6)] == self.games
+        shard.close()
+    def test_datasrc(self):
+        filenames = [os.path.join(self.dir, 'test-{}.shard'.format(i)) for i in range(2)]
+        write_chunk_shard(self.chunks[:4], filenames[0], level=0)
+        write_chunk_shard(self.chunks[4:], filenames[1])
+        src = ChunkShardDataSrc(filenames)
+        assert len(src.chunks) == 6
+        data = [src.next() for _ in range(6)]
+        # One pass reads every game once.
+        assert sorted(data) == sorted(self.games)
+        data = [src.next_sampled(1000) for _ in range(4)]
+        assert sum(len(d) for d in data) < sum(len(g) for g in self.games[2:])
+        state = src.get_state()
+        assert len(state['consumed']) == 4, state
+        assert all('#' in name for name in state['consumed']), state
+
+
+if __name__ == '__main__':
+    usage_str = """
+Pack v3 chunks into chunk shards, each a single mappable file with
+an index of its games and records."""
+
+    parser = argparse.ArgumentParser(
+            formatter_class=argparse.RawDescriptionHelpFormatter,
+            description=usage_str)
+    parser.add_argument("files", type=str, nargs="+",
+            help="training*.gz or training*.zst, globs allowed")
+    parser.add_argument("--output", type=str, required=True,
+            help="prefix of the shard files")
+    parser.add_argument("--games", type=int, default=10000,
+            help="games per shard")
+    parser.add_argument("--block-records", type=int, default=4,
+            help="records per block")
+    parser.add_argument("--level", type=int, default=1,
+            help="zlib level of the blocks, 0 to leave them uncompressed")
+    main(parser.parse_args())
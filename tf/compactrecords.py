@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+#
+#    This file is part of Leela Chess.
+#
+#    Leela Chess is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Leela Chess is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Leela Chess.  If not, see <http://www.gnu.org/licenses/>.
+
+import base64
+import numpy as np
+import unittest
+from v3format import VERSION, V3_BYTES, PROBS, PLANES, SCALARS
+
+# Marks a compact record whose policy is kept in the overflow table.
+OVERFLOW = 0xffff
+
+class CompactRecords:
+    def __init__(self, policy_slots=64):
+        """
+            Converts v3 records to and from a compact fixed size encoding,
+            for holding more records in the same memory.
+
+            A compact record drops the version and stores the policy as up
+            to 'policy_slots' (index, value) pairs of its non-zero entries.
+            The float32 values are kept bit for bit, so expanding a compact
+            record gives back the original v3 record. A record with more
+            non-zero entries than 'policy_slots' keeps its full policy in an
+            overflow table instead, until it is expanded again.
+        """
+        assert 0 < policy_slots < OVERFLOW, policy_slots
+        self.policy_slots = policy_slots
+        self.dtype = np.dtype([
+            ('planes', np.uint8, (832,)),
+            ('scalars', np.uint8, (8,)),
+            ('count', '<u2'),
+            ('overflow', '<u4'),
+            ('index', '<u2', (policy_slots,)),
+            ('value', '<u4', (policy_slots,))])
+        # Size in bytes of a compact record.
+        self.size = self.dtype.itemsize
+        # Full policies of the records that don't fit, by overflow id.
+        self.overflow = {}
+        self.next_overflow = 0
+
+    def compact(self, records):
+        """
+            Convert a contiguous 2-D uint8 array or bytes-like object of v3
+            records to a 2-D uint8 array of compact records.
+        """
+        records = np.frombuffer(records, dtype=np.uint8).reshape(-1, V3_BYTES)
+        n = len(records)
+        out = np.zeros(n, dtype=self.dtype)
+        out['planes'] = records[:, PLANES]
+        out['scalars'] = records[:, SCALARS]
+
+        # Compare the raw bits, so that any non-zero value survives intact.
+        probs = records[:, PROBS].view('<u4')
+        nonzero = probs != 0
+        counts = nonzero.sum(axis=1)
+        fits = counts <= self.policy_slots
+        out['count'] = np.where(fits, counts, OVERFLOW)
+
+        # Scatter the non-zero entries of every fitting record into its
+        # leading slots, in index order.
+        rows, cols = np.nonzero(nonzero & fits[:, None])
+        start = np.cumsum(counts * fits) - counts * fits
+        slots = np.arange(len(rows)) - start[rows]
+        out['index'][rows, slots] = cols
+        out['value'][rows, slots] = probs[rows, cols]
+
+        for i in np.nonzero(~fits)[0]:
+            out['overflow'][i] = self.next_overflow
+            self.overflow[self.next_overflow] = probs[i].tobytes()
+            self.next_overflow = (self.next_overflow + 1) % 2**32
+        return out.view(np.uint8).reshape(n, self.size)
+
+    def expand(self, compact):
+        """
+            Convert a contiguous 2-D uint8 array of compact records back to a
+            2-D uint8 array of v3 records.
+        """
+        compact = np.frombuffer(compact, dtype=self.dtype)
+        n = len(compact)
+        out = np.zeros((n, V3_BYTES), dtype=np.uint8)
+        out[:, :4] = np.frombuffer(VERSION, dtype=np.uint8)
+        out[:, PLANES] = compact['planes']
+        out[:, SCALARS] = compact['scalars']
+
+        probs = out[:, PROBS].view('<u4')
+        counts = compact['count']
+        fits = counts != OVERFLOW
+        rows, slots = np.nonzero(np.arange(self.policy_slots) < np.where(fits, counts, 0)[:, None])
+        probs[rows, compact['index'][rows, slots]] = compact['value'][rows, slots]
+
+        for i in np.nonzero(~fits)[0]:
+            probs[i] = np.frombuffer(self.overflow.pop(int(compact['overflow'][i])), dtype='<u4')
+        return out
+
+    def get_state(self):
+        """
+            Return the overflow table as a dict that can be stored as json.
+        """
+        return {
+            'next_overflow': self.next_overflow,
+            'overflow': {str(k): base64.b64encode(v).decode() for k, v in self.overflow.items()},
+        }
+
+    def set_state(self, state):
+        """
+            Restore the overflow table from a dict returned by get_state().
+        """
+        self.next_overflow = state['next_overflow']
+        self.overflow = {int(k): base64.b64decode(v) for k, v in state['overflow'].items()}
+
+
+class CompactRecordsTest(unittest.TestCase):
+    def records(self, nonzero):
+        """
+            Random v3 records with 'nonzero' non-zero policy entries each.
+        """
+        records = np.random.randint(256, size=(len(nonzero), V3_BYTES), dtype=np.uint8)
+        records[:, :4] = np.frombuffer(VERSION, dtype=np.uint8)
+        probs = records[:, PROBS].view('<u4')
+        probs[:] = 0
+        for i, n in enumerate(nonzero):
+            idx = np.random.choice(1858, n, replace=False)
+            probs[i, idx] = np.random.rand(n).astype(np.float32).view('<u4') | 1
+        return records
+    def test_roundtrip(self):
+        codec = CompactRecords(policy_slots=8)
+        records = self.records([0, 1, 5, 8, 9, 1858, 3])
+        compact = codec.compact(records)
+        assert compact.shape == (7, codec.size), compact.shape
+        # Two of the records don't fit and are kept in the overflow table.
+        assert len(codec.overflow) == 2, len(codec.overflow)
+        out = codec.expand(compact)
+        assert (out == records).all()
+        assert len(codec.overflow) == 0, len(codec.overflow)
+    def test_state(self):
+        codec = CompactRecords(policy_slots=8)
+        records = self.records([9, 1])
+        compact = codec.compact(records)
+        restored = CompactRecords(policy_slots=8)
+        restored.set_state(codec.get_state())
+        assert (restored.expand(compact) == records).all()
+    def test_size(self):
+        codec = CompactRecords(policy_slots=64)
+        # At least 5x smaller than a v3 record.
+        assert codec.size * 5 < V3_BYTES, codec.size
+
+
+if __name__ == '__main__':
+    unittest.main()
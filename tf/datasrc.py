@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+#
+#    This file is part of Leela Chess.
+#
+#    Leela Chess is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Leela Chess is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Leela Chess.  If not, see <http://www.gnu.org/licenses/>.
+
+import chunkcodec
+import multiprocessing as mp
+import os
+import random
+import unittest
+from v3format import ChunkTestCase
+
+class FileDataSrc:
+    """
+        data source yielding chunkdata from chunk files.
+
+        All the workers given a copy of the data source share a single
+        cursor into the chunk list, so each worker claims different chunks
+        and one pass over the window reads every chunk exactly once. Every
+        pass visits the chunks in a new random order, derived from 'seed'
+        so that all the workers agree on it.
+    """
+    def __init__(self, chunks, seed=None):
+        self.chunks = chunks
+        if seed is None:
+            seed = random.randrange(2**32)
+        self.seed = seed
+        # Index of the next chunk to claim, counted over all passes.
+        self.cursor = mp.Value('q', 0)
+        # Chunk order of the current pass, built lazily in each worker.
+        self.order = None
+        self.order_pass = None
+        # Chunks this worker failed to read.
+        self.failed = set()
+        # Chunks to skip in the first pass, already read before a restart.
+        self.consumed = set()
+        # Chance of 1 in this many to keep a record, see next_sampled().
+        self.sample = 1
+
+    def claim(self):
+        """
+            Claim the next chunk index, returning (pass, position).
+        """
+        with self.cursor.get_lock():
+            i = self.cursor.value
+            self.cursor.value += 1
+        return divmod(i, len(self.chunks))
+
+    def chunk(self, n, pos):
+        """
+            Return the filename at 'pos' in the chunk order of pass 'n'.
+        """
+        if self.order_pass != n:
+            self.order = list(range(len(self.chunks)))
+            random.Random(self.seed + n).shuffle(self.order)
+            self.order_pass = n
+        return self.chunks[self.order[pos]]
+
+    def get_state(self):
+        """
+            Return the state to resume reading from with set_state(), as a
+            dict that can be stored as json.
+
+            Chunks claimed by a worker count as read, even if the worker
+            didn't get to send all of their records yet.
+        """
+        n, pos = divmod(self.cursor.value, len(self.chunks) or 1)
+        if n == 0:
+            done = self.consumed
+        else:
+            done = set()
+        done = done.union(self.chunk(n, i) for i in range(pos))
+        return {'seed': self.seed, 'consumed': sorted(done)}
+
+    def set_state(self, state):
+        """
+            Resume from a state returned by get_state(), skipping the chunks
+            already read in its pass. Must be called before the data source
+            is handed to the workers.
+        """
+        self.seed = state['seed']
+        self.cursor.value = 0
+        self.consumed = set(state['consumed']).intersection(self.chunks)
+        self.order_pass = None
+
+    def next(self):
+        if not self.chunks:
+            return None
+        # Give up once a whole pass worth of chunks failed to read.
+        attempts = 0
+        while attempts < len(self.chunks):
+            n, pos = self.claim()
+            filename = self.chunk(n, pos)
+            if n == 0 and filename in self.consumed:
+                continue
+            attempts += 1
+            if filename in self.failed:
+                continue
+            try:
+                return self.read(filename)
+            except:
+                print("failed to parse {}".format(filename))
+                self.failed.add(filename)
+        return None
+
+    def next_sampled(self, sample):
+        """
+            Return the chunkdata of the next chunk with only 1 in 'sample' of
+            its records, reading no more of the chunk than needed for them.
+        """
+        self.sample = sample
+        try:
+            return self.next()
+        finally:
+            self.sample = 1
+
+    def read(self, filename):
+        """
+            Return the chunkdata of chunk 'filename', sampled 1 in
+            'self.sample', with the codec of its extension. Chunks indexed
+            by gzindex.py are only decompressed where the records kept are.
+        """
+        return chunkcodec.read_chunk(filename, self.sample)
+
+
+def _read_chunks(src, count, queue):
+    queue.put([src.next() for _ in range(count)])
+
+
+class FileDataSrcTest(ChunkTestCase):
+    def setUp(self):
+        super().setUp()
+        self.chunks = self.write_chunks([str(i).encode() for i in range(10)])
+    def test_passes(self):
+        src = FileDataSrc(self.chunks)
+        data = [src.next() for _ in range(20)]
+        expected = sorted([str(i).encode() for i in range(10)])
+        # Every pass reads each chunk once, in a different order.
+        assert sorted(data[:10]) == expected, data
+        assert sorted(data[10:]) == expected, data
+        assert data[:10] != data[10:], data
+    def test_shared_cursor(self):
+        src = FileDataSrc(self.chunks)
+        queue = mp.Queue()
+        processes = [mp.Process(target=_read_chunks, args=(src, 5, queue)) for _ in range(2)]
+        for p in processes:
+            p.start()
+        data = queue.get() + queue.get()
+        for p in processes:
+            p.join()
+        # Two workers reading 5 chunks each read every chunk exactly once.
+        assert sorted(data) == sorted([str(i).encode() for i in range(10)]), data
+    def test_failed(self):
+        src = FileDataSrc(self.chunks + [os.path.join(self.dir, 'missing.gz')])
+        data = [src.next() for _ in range(20)]
+        assert None not in data, data
+    def test_state(self):
+        src = FileDataSrc(self.chunks)
+        first = [src.next() for _ in range(4)]
+        state = src.get_state()
+        assert len(state['consumed']) == 4, state
+        # A new data source, possibly with the chunks in another order,
+        # finishes the pass without the chunks already read.
+        resumed = FileDataSrc(list(reversed(self.chunks)))
+        resumed.set_state(state)
+        rest = [resumed.next() for _ in range(6)]
+        assert sorted(first + rest) == sorted([str(i).encode() for i in range(10)]), rest
+        # And reads every chunk again in the next pass.
+        data = [resumed.next() for _ in range(10)]
+        assert sorted(data) == sorted([str(i).encode() for i in range(10)]), data
+
+
+if __name__ == '__main__':
+    unittest.main()
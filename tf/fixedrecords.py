@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+#
+#    This file is part of Leela Chess.
+#
+#    Leela Chess is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Leela Chess is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Leela Chess.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import glob
+import numpy as np
+import os
+import unittest
+import chunkcodec
+from chunkparser import ChunkParser
+from v3format import VERSION, V3_BYTES, PROBS, PLANES, SCALARS, ChunkTestCase, synthetic_chunk
+
+
+def write_record_files(chunks, prefix, file_records=65536, sample=1, seed=None):
+    """
+        Write the v3 records of the chunk files 'chunks' to record files
+        of 'file_records' records each, named prefix-00000.bin and so on,
+        keeping 1 in 'sample' records. A record file is just the records
+        one after the other, shuffled, so that tf.data can read it as fixed
+        length records. Returns the filenames of the record files.
+    """
+    rng = np.random.default_rng(seed)
+    filenames = []
+    pending = []
+    count = 0
+
+    def flush(n):
+        rows = np.concatenate(pending)
+        shuffled = rows[:n][rng.permutation(n)]
+        filename = '{}-{:05d}.bin'.format(prefix, len(filenames))
+        with open(filename + '.tmp', 'wb') as f:
+            f.write(shuffled.tobytes())
+        os.replace(filename + '.tmp', filename)
+        filenames.append(filename)
+        return [rows[n:]]
+
+    for chunk in chunks:
+        try:
+            data = chunkcodec.read_chunk(chunk)
+        except:
+            print("failed to parse {}".format(chunk))
+            continue
+        if data[0:4] != VERSION:
+            print("skipping {}, not v3".format(chunk))
+            continue
+        records = np.frombuffer(data, dtype=np.uint8)
+        records = records[:len(records) // V3_BYTES * V3_BYTES].reshape(-1, V3_BYTES)
+        if sample > 1:
+            records = records[rng.integers(sample, size=len(records)) == 0]
+        pending.append(records)
+        count += len(records)
+        while count >= file_records:
+            pending = flush(file_records)
+            count -= file_records
+    if count:
+        flush(count)
+    return filenames
+
+
+def parse_records(records):
+    """
+        Convert a batch of v3 records as strings to the tensors
+        parse_function returns, all on the graph.
+    """
+    import tensorflow as tf
+    data = tf.reshape(tf.decode_raw(records, tf.uint8), (-1, V3_BYTES))
+    probs = tf.bitcast(tf.reshape(data[:, PROBS], (-1, 1858, 4)), tf.float32)
+    return ChunkParser.expand_packed(data[:, PLANES], probs, data[:, SCALARS])
+
+
+def record_dataset(filenames, batch_size, shuffle_size, sample=1, readers=8, parallel_calls=4,
+        prefetch=4, repeat=True):
+    """
+        Return a tf.data dataset of batches of 'batch_size' records read
+        from the record files 'filenames', as parse_function returns them.
+
+        'readers' files are read at a time, interleaving their records,
+        which then go through a shuffle buffer of 'shuffle_size' records.
+        With 'sample' only 1 in that many records is used. Batches are
+        decoded on the graph by 'parallel_calls' parallel calls, so Python
+        never sees a record. ChunkParser.BATCH_SIZE must be 'batch_size'.
+        Only uses ops TensorFlow 1.4 has.
+    """
+    import tensorflow as tf
+    assert ChunkParser.BATCH_SIZE == batch_size, (ChunkParser.BATCH_SIZE, batch_size)
+    dataset = tf.data.Dataset.from_tensor_slices(filenames)
+    if repeat:
+        # A new file order every pass.
+        dataset = dataset.shuffle(len(filenames)).repeat()
+    dataset = dataset.interleave(lambda f: tf.data.FixedLengthRecordDataset(f, V3_BYTES),
+            cycle_length=readers)
+    if sample > 1:
+        dataset = dataset.filter(lambda r: tf.random_uniform([]) < 1.0 / sample)
+    dataset = dataset.shuffle(shuffle_size)
+    dataset = dataset.batch(batch_size)
+    # Drop a last partial batch.
+    dataset = dataset.filter(lambda r: tf.equal(tf.shape(r)[0], batch_size))
+    dataset = dataset.map(parse_records, num_parallel_calls=parallel_calls)
+    return dataset.prefetch(prefetch)
+
+
+def total_records(filenames):
+    """
+        Return the number of records in the record files 'filenames'.
+    """
+    return sum(os.path.getsize(f) // V3_BYTES for f in filenames)
+
+
+def main(args):
+    chunks = []
+    for pattern in args.files:
+        chunks += glob.glob(pattern)
+    filenames = write_record_files(chunks, args.output, args.records, args.sample)
+    print("Wrote {} records from {} chunks to {} record files".format(
+        total_records(filenames), len(chunks), len(filenames)))
+
+
+class FixedRecordsTest(ChunkTestCase):
+    def setUp(self):
+        super().setUp()
+        data = synthetic_chunk(self.rng, 25)
+        self.records = np.frombuffer(data, dtype=np.uint8).reshape(25, V3_BYTES)
+        self.chunks = self.write_chunks([self.records[5 * i:5 * i + 5].tobytes() for i in range(5)])
+    def test_write(self):
+        filenames = write_record_files(self.chunks, os.path.join(self.dir, 'records'), file_records=10)
+        assert [os.path.basename(f) for f in filenames] == ['records-00000.bin', 'records-00001.bin', 'records-00002.bin']
+        assert total_records(filenames) == 25
+        data = b''.join(open(f, 'rb').read() for f in filenames)
+        rows = np.frombuffer(data, dtype=np.uint8).reshape(-1, V3_BYTES)
+        # Every record once, shuffled.
+        assert sorted(rows.tolist()) == sorted(self.records.tolist())
+    def test_sample(self):
+        filenames = write_record_files(self.chunks, os.path.join(self.dir, 'records'), sample=5, seed=1)
+        assert 0 < total_records(filenames) < 25, total_records(filenames)
+    @unittest.skipIf(chunkcodec.zstandard is None, "needs zstandard")
+    def test_zst(self):
+        chunks = chunkcodec.reencode(self.chunks, os.path.join(self.dir, 'zst'), dict_size=4096)
+        filenames = write_record_files(chunks, os.path.join(self.dir, 'records'))
+        assert total_records(filenames) == 25
+    def test_tensorflow_dataset(self):
+        import tensorflow as tf
+        filenames = write_record_files(self.chunks, os.path.join(self.dir, 'records'), file_records=25)
+        ChunkParser.BATCH_SIZE = 5
+        dataset = record_dataset(filenames, 5, shuffle_size=1, readers=1, repeat=False)
+        batches = dataset.make_one_shot_iterator().get_next()
+        rows = np.fromfile(filenames[0], dtype=np.uint8).reshape(-1, V3_BYTES)
+        with tf.Session() as sess:
+            for i in range(5):
+                planes, probs, winner = sess.run(batches)
+                expected = ChunkParser.convert_v3_batch(rows[5 * i:5 * i + 5])
+                assert planes.tobytes() == expected[0]
+                assert probs.tobytes() == expected[1]
+                assert winner.tobytes() == expected[2]
+
+
+if __name__ == '__main__':
+    usage_str = """
+Pack v3 chunks into files of fixed length records for the native tf.data
+input path."""
+
+    parser = argparse.ArgumentParser(
+            formatter_class=argparse.RawDescriptionHelpFormatter,
+            description=usage_str)
+    parser.add_argument("files", type=str, nargs="+",
+            help="training*.gz or training*.zst, globs allowed")
+    parser.add_argument("--output", type=str, required=True,
+            help="prefix of the record files")
+    parser.add_argument("--records", type=int, default=65536,
+            help="records per file")
+    parser.add_argument("--sample", type=int, default=1,
+            help="keep 1 in this many records")
+    main(parser.parse_args())
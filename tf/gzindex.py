@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+#
+#    This file is part of Leela Chess.
+#
+#    Leela Chess is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Leela Chess is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Leela Chess.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import ctypes
+import ctypes.util
+import glob
+import gzip
+import numpy as np
+import os
+import struct
+import zlib
+from v3format import VERSION, V3_BYTES, ChunkTestCase, synthetic_chunk
+
+MAGIC = b'LCGZ'
+FORMAT = 1
+# magic, format, size of the chunk, size of its chunkdata, records,
+# checkpoints.
+HEADER = struct.Struct('<4sIQQQI')
+# Bytes of output a deflate stream can refer back to.
+WINDOW = 32768
+# Flush mode of inflate() returning at the end of every deflate block.
+Z_BLOCK = 5
+Z_STREAM_END = 1
+
+class ZStream(ctypes.Structure):
+    _fields_ = [
+        ('next_in', ctypes.c_void_p), ('avail_in', ctypes.c_uint), ('total_in', ctypes.c_ulong),
+        ('next_out', ctypes.c_void_p), ('avail_out', ctypes.c_uint), ('total_out', ctypes.c_ulong),
+        ('msg', ctypes.c_char_p), ('state', ctypes.c_void_p),
+        ('zalloc', ctypes.c_void_p), ('zfree', ctypes.c_void_p), ('opaque', ctypes.c_void_p),
+        ('data_type', ctypes.c_int), ('adler', ctypes.c_ulong), ('reserved', ctypes.c_ulong)]
+
+
+def index_filename(filename):
+    return filename + '.idx'
+
+
+def build_index(filename, span=65536):
+    """
+        Write the index of gzipped chunk 'filename' next to it, and return
+        the number of records in the chunk.
+
+        Like zran.c, the index holds decompression checkpoints at the ends
+        of deflate blocks, at least 'span' bytes of chunkdata apart. Each
+        has its offsets into the chunk and the chunkdata, the bits of its
+        first byte already used, and the 32KiB of chunkdata before it,
+        which a deflate stream can refer back to. Python's zlib doesn't
+        report block ends, so this calls libz itself.
+    """
+    libz = ctypes.CDLL(ctypes.util.find_library('z'))
+    libz.zlibVersion.restype = ctypes.c_char_p
+    with open(filename, 'rb') as f:
+        raw = f.read()
+    # A single gzip member, its size modulo 2^32 in the trailer.
+    size = struct.unpack('<I', raw[-4:])[0]
+    src = ctypes.create_string_buffer(raw, len(raw))
+    out = ctypes.create_string_buffer(size + 1)
+    strm = ZStream()
+    # Accept a gzip header.
+    if libz.inflateInit2_(ctypes.byref(strm), 15 + 32, libz.zlibVersion(), ctypes.sizeof(strm)):
+        raise ValueError("inflateInit2 failed")
+    strm.next_in = ctypes.addressof(src)
+    strm.avail_in = len(raw)
+    strm.next_out = ctypes.addressof(out)
+    strm.avail_out = size + 1
+    points = []
+    try:
+        while True:
+            ret = libz.inflate(ctypes.byref(strm), Z_BLOCK)
+            if ret == Z_STREAM_END:
+                break
+            if ret != 0:
+                raise ValueError("{} is not a gzip file".format(filename))
+            # At the end of a block that is not the last one.
+            if strm.data_type & 128 and not strm.data_type & 64:
+                total = strm.total_out
+                if not points or total - points[-1][0] >= span:
+                    window = out.raw[max(0, total - WINDOW):total]
+                    points.append((total, strm.total_in, strm.data_type & 7, zlib.compress(window, 1)))
+    finally:
+        libz.inflateEnd(ctypes.byref(strm))
+    total = strm.total_out
+    with open(index_filename(filename) + '.tmp', 'wb') as f:
+        f.write(HEADER.pack(MAGIC, FORMAT, len(raw), total, total // V3_BYTES, len(points)))
+        f.write(np.array([p[0] for p in points], dtype='<u8').tobytes())
+        f.write(np.array([p[1] for p in points], dtype='<u8').tobytes())
+        f.write(np.array([p[2] for p in points], dtype='u1').tobytes())
+        f.write(np.array([len(p[3]) for p in points], dtype='<u4').tobytes())
+        for p in points:
+            f.write(p[3])
+    os.replace(index_filename(filename) + '.tmp', index_filename(filename))
+    return total // V3_BYTES
+
+
+def load_index(filename):
+    """
+        Return the index of gzipped chunk 'filename' as a dict, or None if
+        it has none, or one for another version of the chunk.
+    """
+    try:
+        with open(index_filename(filename), 'rb') as f:
+            data = f.read()
+    except OSError:
+        return None
+    magic, fmt, size, total, records, n = HEADER.unpack_from(data)
+    if magic != MAGIC or fmt != FORMAT:
+        return None
+    offset = HEADER.size
+    index = {'size': size, 'total': total, 'records': records}
+    for key, dtype in (('out', '<u8'), ('in', '<u8'), ('bits', 'u1'), ('window', '<u4')):
+        index[key] = np.frombuffer(data, dtype=dtype, count=n, offset=offset)
+        offset += index[key].nbytes
+    ends = offset + np.cumsum(index['window'])
+    index['windows'] = [data[end - length:end] for end, length in zip(ends, index['window'])]
+    return index
+
+
+def record_count(filename):
+    """
+        Return the number of records of gzipped chunk 'filename' from its
+        index, without opening the chunk, or None without an index.
+    """
+    try:
+        with open(index_filename(filename), 'rb') as f:
+            magic, fmt, size, total, records, n = HEADER.unpack(f.read(HEADER.size))
+    except (OSError, struct.error):
+        return None
+    if magic != MAGIC or fmt != FORMAT:
+        return None
+    return records
+
+
+def inflate_from(raw, index, point, length):
+    """
+        Return 'length' bytes of chunkdata from checkpoint 'point' of
+        'index' into the compressed chunk 'raw'.
+    """
+    start, bits = int(index['in'][point]), int(index['bits'][point])
+    if bits:
+        # Drop the bits of the first byte that belong to the block before,
+        # instead of inflatePrime(), which zlib doesn't expose.
+        data = raw[start - 1:]
+        data = (int.from_bytes(data, 'little') >> (8 - bits)).to_bytes(len(data), 'little')
+    else:
+        data = raw[start:]
+    window = zlib.decompress(index['windows'][point])
+    if window:
+        d = zlib.decompressobj(-15, zdict=window)
+    else:
+        d = zlib.decompressobj(-15)
+    return d.decompress(data, length)
+
+
+def sample_records(data, sample):
+    """
+        Return the v3 records of 'data' concatenated, keeping each with a
+        chance of 1 in 'sample'.
+    """
+    if data[0:4] != VERSION:
+        return data
+    records = np.frombuffer(data, dtype=np.uint8, count=len(data) // V3_BYTES * V3_BYTES)
+    records = records.reshape(-1, V3_BYTES)
+    return records[np.random.randint(sample, size=len(records)) == 0].tobytes()
+
+
+def read_chunk(filename, sample=1):
+    """
+        Return the chunkdata of gzipped chunk 'filename', keeping each v3
+        record with a chance of 1 in 'sample'.
+
+        With an up to date index, only the chunkdata from the checkpoints
+        before the records kept to the last of them is decompressed.
+    """
+    index = load_index(filename) if sample > 1 else None
+    with open(filename, 'rb') as f:
+        raw = f.read()
+    if index is None or index['size'] != len(raw) or not len(index['out']):
+        data = gzip.decompress(raw)
+        return data if sample == 1 else sample_records(data, sample)
+    keep = np.flatnonzero(np.random.randint(sample, size=index['records']) == 0)
+    out = []
+    # Records from the same checkpoint share one decompression.
+    points = np.searchsorted(index['out'], keep * V3_BYTES, side='right') - 1
+    for point in np.unique(points):
+        records = keep[points == point]
+        base = int(index['out'][point])
+        data = inflate_from(raw, index, point, int(records[-1] + 1) * V3_BYTES - base)
+        for r in records:
+            start = int(r) * V3_BYTES - base
+            out.append(data[start:start + V3_BYTES])
+    return b''.join(out)
+
+
+def main(args):
+    chunks = []
+    for pattern in args.files:
+        chunks += glob.glob(pattern)
+    records = 0
+    for chunk in chunks:
+        try:
+            records += build_index(chunk, args.span)
+        except Exception as e:
+            print("failed to index {}: {}".format(chunk, e))
+    print("Indexed {} records in {} chunks".format(records, len(chunks)))
+
+
+class GzIndexTest(ChunkTestCase):
+    def setUp(self):
+        super().setUp()
+        # Enough records for several deflate blocks.
+        self.data = synthetic_chunk(self.rng, 600)
+        self.filename, = self.write_chunks([self.data])
+    def test_checkpoints(self):
+        assert build_index(self.filename, span=0) == 600
+        assert record_count(self.filename) == 600
+        index = load_index(self.filename)
+        assert len(index['out']) > 4, index['out']
+        # Some checkpoints start within a byte.
+        assert index['bits'].any(), index['bits']
+        raw = open(self.filename, 'rb').read()
+        for point, out in enumerate(index['out']):
+            data = inflate_from(raw, index, point, 1000)
+            assert data == self.data[out:out + 1000], point
+    def test_read_chunk(self):
+        build_index(self.filename, span=20000)
+        records = [self.data[i:i + V3_BYTES] for i in range(0, len(self.data), V3_BYTES)]
+        assert read_chunk(self.filename) == self.data
+        data = read_chunk(self.filename, sample=4)
+        assert 0 < len(data) < len(self.data) and len(data) % V3_BYTES == 0
+        assert all(data[i:i + V3_BYTES] in records for i in range(0, len(data), V3_BYTES))
+        # Everything is kept with 'sample' 1 in 1.
+        assert read_chunk(self.filename, sample=1) == self.data
+    def test_stale_index(self):
+        build_index(self.filename)
+        with gzip.open(self.filename, 'wb') as f:
+            f.write(self.data[:V3_BYTES])
+        assert load_index(self.filename)['size'] != os.path.getsize(self.filename)
+        assert read_chunk(self.filename, sample=1000000) in (b'', self.data[:V3_BYTES])
+
+
+if __name__ == '__main__':
+    usage_str = """
+Index gzipped chunks for reading sampled records without decompressing the
+whole chunk, writing an .idx file next to every chunk."""
+
+    parser = argparse.ArgumentParser(
+            formatter_class=argparse.RawDescriptionHelpFormatter,
+            description=usage_str)
+    parser.add_argument("files", type=str, nargs="+",
+            help="training*.gz, globs allowed")
+    parser.add_argument("--span", type=int, default=65536,
+            help="least bytes of chunkdata between checkpoints")
+    main(parser.parse_args())
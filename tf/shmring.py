@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+#
+#    This file is part of Leela Chess.
+#
+#    Leela Chess is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Leela Chess is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Leela Chess.  If not, see <http://www.gnu.org/licenses/>.
+
+import multiprocessing as mp
+import os
+import struct
+import time
+import unittest
+try:
+    # Python 3.8+, only needed for the 'shm' transport.
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
+
+# Ring header: number of slots written, closed flag.
+HEADER = struct.Struct('QQ')
+# Slot header: length of the message in the slot.
+SLOT_HEADER = struct.Struct('Q')
+# Seconds between checks of a watched writer while waiting for a message.
+RECV_POLL = 0.1
+
+class ShmRing:
+    def __init__(self, slot_size, slot_count):
+        """
+            A single producer, single consumer ring of messages in shared
+            memory.
+
+            Holds up to 'slot_count' messages of at most 'slot_size' bytes
+            each. It mimics the send_bytes/recv_bytes interface of a
+            multiprocessing Connection, so it can be used in place of one end
+            of an mp.Pipe. Messages are copied straight into and out of the
+            shared mapping, without pickling or going through the kernel.
+
+            The ring object is passed to the child process, which then owns
+            the writing side. Only the creating process unlinks the shared
+            memory.
+        """
+        assert slot_size > 0, slot_size
+        assert slot_count > 0, slot_count
+        self.slot_size = slot_size
+        self.slot_count = slot_count
+        self.stride = SLOT_HEADER.size + slot_size
+        self.shm = shared_memory.SharedMemory(create=True,
+                size=HEADER.size + self.stride * slot_count)
+        HEADER.pack_into(self.shm.buf, 0, 0, 0)
+        # Counting semaphores for the free and filled slots.
+        self.free = mp.Semaphore(slot_count)
+        self.filled = mp.Semaphore(0)
+        # Slot position of this side of the ring.
+        self.pos = 0
+        self.owner = os.getpid()
+        # Process writing to the ring, see watch().
+        self.writer = None
+
+    def watch(self, process):
+        """
+            Make recv_bytes() raise EOFError once 'process', the writer, has
+            died without closing the ring. Must be called after the process
+            started, by the process that started it.
+        """
+        self.writer = process
+
+    def _slot(self, pos):
+        return HEADER.size + (pos % self.slot_count) * self.stride
+
+    def send_bytes(self, data):
+        """
+            Copy 'data' into the next free slot, blocking while the ring is
+            full.
+        """
+        assert len(data) <= self.slot_size, len(data)
+        self.free.acquire()
+        offset = self._slot(self.pos)
+        SLOT_HEADER.pack_into(self.shm.buf, offset, len(data))
+        offset += SLOT_HEADER.size
+        self.shm.buf[offset:offset + len(data)] = data
+        self.pos += 1
+        HEADER.pack_into(self.shm.buf, 0, self.pos, 0)
+        self.filled.release()
+
+    def poll(self, timeout=0.0):
+        """
+            Return whether there is a message or EOF to be read, waiting
+            at most 'timeout' seconds.
+        """
+        if not self.filled.acquire(timeout=timeout):
+            return False
+        self.filled.release()
+        return True
+
+    def recv_bytes(self):
+        """
+            Return the next message, blocking while the ring is empty.
+
+            Raises EOFError once the writer has closed the ring and all
+            messages have been read, or once a watched writer has died.
+        """
+        while not self.filled.acquire(timeout=RECV_POLL):
+            if self.writer is not None and not self.writer.is_alive():
+                # A message may have come in just before the writer died.
+                if not self.filled.acquire(block=False):
+                    raise EOFError
+                break
+        written, closed = HEADER.unpack_from(self.shm.buf, 0)
+        if self.pos >= written:
+            # Woken up by close(), keep waking up further readers.
+            self.filled.release()
+            raise EOFError
+        offset = self._slot(self.pos)
+        length, = SLOT_HEADER.unpack_from(self.shm.buf, offset)
+        offset += SLOT_HEADER.size
+        data = bytes(self.shm.buf[offset:offset + length])
+        self.pos += 1
+        self.free.release()
+        return data
+
+    def close(self):
+        """
+            Signal EOF to the reader and release the shared memory.
+        """
+        if self.shm is None:
+            return
+        written, closed = HEADER.unpack_from(self.shm.buf, 0)
+        HEADER.pack_into(self.shm.buf, 0, written, 1)
+        self.filled.release()
+        self.shm.close()
+        if self.owner == os.getpid():
+            self.shm.unlink()
+        self.shm = None
+
+
+def Pipe(slot_size, slot_count):
+    """
+        Return a (reader, writer) pair backed by one ShmRing, like mp.Pipe.
+    """
+    ring = ShmRing(slot_size, slot_count)
+    return ring, ring
+
+
+def wait(readers, timeout):
+    """
+        Return the readers in 'readers' that have a message or EOF ready,
+        waiting at most 'timeout' seconds for one, like mp.connection.wait
+        but also for rings.
+    """
+    if not any(isinstance(r, ShmRing) for r in readers):
+        return mp.connection.wait(readers, timeout)
+    # Shared memory rings have no file descriptor to wait on, so poll.
+    deadline = time.time() + timeout
+    while True:
+        ready = [r for r in readers if r.poll()]
+        if ready or time.time() >= deadline:
+            return ready
+        time.sleep(0.001)
+
+
+def _write_all(ring, items):
+    for item in items:
+        ring.send_bytes(item)
+    ring.close()
+
+
+def _write_and_die(ring, items):
+    for item in items:
+        ring.send_bytes(item)
+    os._exit(1)
+
+
+@unittest.skipIf(shared_memory is None, "needs Python 3.8+")
+class ShmRingTest(unittest.TestCase):
+    def test_send_recv(self):
+        ring = ShmRing(slot_size=4, slot_count=2)
+        assert not ring.poll(), "empty ring should not poll"
+        ring.send_bytes(b'1234')
+        ring.send_bytes(b'5')
+        assert ring.poll()
+        # Both sides share 'pos' in this process, so rewind the reader.
+        ring.pos = 0
+        r = ring.recv_bytes()
+        assert r == b'1234', r
+        r = ring.recv_bytes()
+        assert r == b'5', r
+        ring.close()
+    def test_too_large(self):
+        ring = ShmRing(slot_size=3, slot_count=1)
+        try:
+            ring.send_bytes(b'1234') # too large, so should throw.
+            assert False # Should not be reached.
+        except AssertionError:
+            pass
+        ring.close()
+    def test_process(self):
+        n=100 # number of test items, more than fit in the ring.
+        items=[bytes([x]) * (x % 7 + 1) for x in range(n)]
+        reader, writer = Pipe(slot_size=8, slot_count=3)
+        p = mp.Process(target=_write_all, args=(writer, items))
+        p.start()
+        out=[]
+        try:
+            while True:
+                out.append(reader.recv_bytes())
+        except EOFError:
+            pass
+        p.join()
+        assert out == items, out
+        reader.close()
+    def test_writer_died(self):
+        reader, writer = Pipe(slot_size=1, slot_count=4)
+        p = mp.Process(target=_write_and_die, args=(writer, [b'1', b'2']))
+        p.start()
+        reader.watch(p)
+        p.join()
+        # The messages sent before dying are still read, then EOF.
+        assert reader.recv_bytes() == b'1'
+        assert reader.recv_bytes() == b'2'
+        with self.assertRaises(EOFError):
+            reader.recv_bytes()
+        reader.close()
+    def test_wait(self):
+        rings = [ShmRing(slot_size=1, slot_count=1) for _ in range(2)]
+        assert wait(rings, 0.01) == []
+        rings[1].send_bytes(b'1')
+        assert wait(rings, 0.01) == [rings[1]]
+        for ring in rings:
+            ring.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
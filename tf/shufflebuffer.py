@@ -16,16 +16,31 @@
 #    You should have received a copy of the GNU General Public License
 #    along with Leela Chess.  If not, see <http://www.gnu.org/licenses/>.
 
-import random
+import mmap
+import numpy as np
+import os
+import shutil
+import tempfile
 import unittest
 
 class ShuffleBuffer:
-    def __init__(self, elem_size, elem_count):
+    def __init__(self, elem_size, elem_count, seed=None, path=None, min_fill=None):
         """
             A shuffle buffer for fixed sized elements.
 
             Manages 'elem_count' items in a fixed buffer, each item being exactly
-            'elem_size' bytes.
+            'elem_size' bytes. Items can be inserted one at a time, or many at
+            once as a 2-D uint8 array with one item per row.
+
+            If 'path' is set, the buffer is a file in that directory mapped
+            into memory, so it can be larger than RAM when backed by fast
+            local storage, or use huge pages on hugetlbfs. The file is
+            unlinked as soon as it's mapped, so it never outlives the buffer.
+
+            If 'min_fill' is set, the buffer starts returning items once it
+            holds 'min_fill' items rather than only once it's full. Every
+            insert then returns an item with a probability ramping from 0 to
+            1/2 as the buffer fills up, so it still gets full.
         """
         assert elem_size > 0, elem_size
         assert elem_count > 0, elem_count
@@ -33,10 +48,74 @@ class ShuffleBuffer:
         self.elem_size = elem_size
         # Number of elements in the buffer.
         self.elem_count = elem_count
-        # Fixed size buffer used to hold all the element.
-        self.buffer = bytearray(elem_size * elem_count)
+        # Fixed size buffer used to hold all the element, one per row.
+        self.mmap = None
+        if path is None:
+            self.buffer = np.zeros((elem_count, elem_size), dtype=np.uint8)
+        else:
+            self.buffer = self.map_file(path)
         # Number of elements actually contained in the buffer.
         self.used = 0
+        # Number of elements from which to return items while filling up.
+        if min_fill is None or min_fill >= elem_count:
+            min_fill = elem_count
+        self.min_fill = max(0, min_fill)
+        # Source of the random replacement positions.
+        self.rng = np.random.default_rng(seed)
+
+    def map_file(self, path):
+        """
+            Map a new file in directory 'path' as the buffer.
+        """
+        size = self.elem_size * self.elem_count
+        # Files on hugetlbfs must be a multiple of the huge page size, which
+        # is also the block size reported for the file system.
+        block = os.statvfs(path).f_bsize
+        fd, filename = tempfile.mkstemp(prefix='shufflebuffer-', dir=path)
+        try:
+            os.ftruncate(fd, -(-size // block) * block)
+            self.mmap = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+            os.unlink(filename)
+        # Items are replaced at random positions, so read-ahead is wasted.
+        if hasattr(mmap, 'MADV_RANDOM'):
+            self.mmap.madvise(mmap.MADV_RANDOM)
+        return np.frombuffer(self.mmap, dtype=np.uint8).reshape(self.elem_count, self.elem_size)
+
+    def close(self):
+        """
+            Release the buffer. The shuffle buffer can't be used afterwards.
+        """
+        self.buffer = None
+        self.used = 0
+        if self.mmap is not None:
+            try:
+                self.mmap.close()
+            except BufferError:
+                pass  # still in use elsewhere, unmapped once that's done.
+            self.mmap = None
+
+    def save(self, filename):
+        """
+            Write the items in the buffer to 'filename' as raw rows, so the
+            file can be loaded back or mapped as a 2-D uint8 array.
+        """
+        with open(filename, 'wb') as f:
+            f.write(memoryview(self.buffer[:self.used]).cast('B'))
+
+    def load(self, filename):
+        """
+            Replace the contents of the buffer with items written by save(),
+            dropping any that don't fit. Returns the number of items loaded.
+        """
+        size = os.path.getsize(filename)
+        assert size % self.elem_size == 0, size
+        count = min(size // self.elem_size, self.elem_count)
+        with open(filename, 'rb') as f:
+            f.readinto(memoryview(self.buffer[:count]).cast('B'))
+        self.used = count
+        return count
 
     def extract(self):
         """
@@ -49,15 +128,33 @@ class ShuffleBuffer:
         # The items in the shuffle buffer are held in shuffled order
         # so returning the last item is sufficient.
         self.used -= 1
-        i = self.used
-        return self.buffer[i * self.elem_size : (i+1) * self.elem_size]
+        return self.buffer[self.used].tobytes()
+
+    def extract_many(self, count):
+        """
+            Return up to 'count' items from the shuffle buffer as a 2-D
+            array.
+        """
+        count = min(count, self.used)
+        self.used -= count
+        return self.buffer[self.used : self.used + count].copy()
+
+    def warm_rate(self):
+        """
+            Return the probability of an insert returning an item while
+            the buffer is filling up.
+        """
+        if self.used < self.min_fill or self.used >= self.elem_count:
+            return 0.0
+        return 0.5 * (self.used - self.min_fill) / (self.elem_count - self.min_fill)
 
     def insert_or_replace(self, item):
         """
             Inserts 'item' into the shuffle buffer, returning
             a random item.
 
-            If the buffer is not yet full, returns None
+            If the buffer is not yet full, returns None, unless it holds at
+            least 'min_fill' items and an item is drawn at the warm-up rate.
         """
         assert len(item) == self.elem_size, len(item)
         # putting the new item in a random location, and appending
@@ -65,20 +162,69 @@ class ShuffleBuffer:
         # random shuffle (Fisher-Yates)
         if self.used > 0:
             # swap 'item' with random item in buffer.
-            i = random.randint(0, self.used-1)
-            old_item = self.buffer[i * self.elem_size : (i+1) * self.elem_size]
-            self.buffer[i * self.elem_size : (i+1) * self.elem_size] = item
+            i = self.rng.integers(self.used)
+            old_item = self.buffer[i].tobytes()
+            self.buffer[i] = np.frombuffer(item, dtype=np.uint8)
             item = old_item
         # If the buffer isn't yet full, append 'item' to the end of the buffer.
         if self.used < self.elem_count:
             # Not yet full, so place the returned item at the end of the buffer.
-            i = self.used
-            self.buffer[i * self.elem_size : (i+1) * self.elem_size] = item
+            self.buffer[self.used] = np.frombuffer(item, dtype=np.uint8)
             self.used += 1
+            rate = self.warm_rate()
+            if rate and self.rng.random() < rate:
+                return self.extract()
             return None
         return item
-        
- 
+
+    def insert_or_replace_many(self, items):
+        """
+            Inserts the items in 'items' into the shuffle buffer, returning
+            a 2-D array with one random item per inserted item.
+
+            'items' is a contiguous 2-D uint8 array or bytes-like object
+            holding whole items. While the buffer is not yet full, fewer
+            items are returned. The result is the same as calling
+            insert_or_replace for every item in turn.
+        """
+        items = np.frombuffer(items, dtype=np.uint8)
+        assert len(items) % self.elem_size == 0, len(items)
+        items = items.reshape(-1, self.elem_size)
+        # Fill up the buffer one item at a time.
+        n = 0
+        warm = []
+        while n < len(items) and self.used < self.elem_count:
+            r = self.insert_or_replace(items[n])
+            if r is not None:
+                warm.append(r)
+            n += 1
+        out = self.replace_many(items[n:])
+        if warm:
+            warm = np.frombuffer(b''.join(warm), dtype=np.uint8).reshape(-1, self.elem_size)
+            out = np.concatenate([warm, out])
+        return out
+
+    def replace_many(self, items):
+        """
+            Swap each row of the 2-D array 'items' with a random item in the
+            full buffer, returning the displaced items.
+        """
+        idx = self.rng.integers(self.used, size=len(items))
+        out = self.buffer[idx]
+        # When a position is drawn more than once, the later item displaces
+        # the item inserted by the previous draw rather than the original.
+        order = np.argsort(idx, kind='stable')
+        dup = np.nonzero(idx[order[1:]] == idx[order[:-1]])[0]
+        if not len(dup):
+            self.buffer[idx] = items
+            return out
+        out[order[dup + 1]] = items[order[dup]]
+        last = np.ones(len(items), dtype=bool)
+        last[order[dup]] = False
+        self.buffer[idx[last]] = items[last]
+        return out
+
+
 class ShuffleBufferTest(unittest.TestCase):
     def test_extract(self):
         sb = ShuffleBuffer(3, 1)
@@ -115,6 +261,66 @@ class ShuffleBufferTest(unittest.TestCase):
         # Check that buffer is empty
         r = sb.extract()
         assert r is None, r
+    def test_insert_or_replace_many(self):
+        n=1000 # number of test items.
+        items=np.array([[x % 256, x // 256, 0] for x in range(n)], dtype=np.uint8)
+        sb = ShuffleBuffer(elem_size=3, elem_count=10)
+        out=[]
+        # Blocks much larger than the buffer draw repeated positions.
+        for i in range(0, n, 100):
+            out += sb.insert_or_replace_many(items[i:i+100]).tolist()
+        # Buffer size is 10, 1000 items, should be 990 seen so far.
+        assert len(out) == n - 10, len(out)
+        out += sb.extract_many(10).tolist()
+        assert sorted(items.tolist()) == sorted(out)
+        assert sb.extract() is None
+    def test_file_backed(self):
+        path = tempfile.mkdtemp()
+        try:
+            sb = ShuffleBuffer(elem_size=3, elem_count=2, path=path)
+            # The file is unlinked once mapped.
+            assert os.listdir(path) == [], os.listdir(path)
+            items=[bytes([x,x,x]) for x in range(10)]
+            out=[sb.insert_or_replace(i) for i in items]
+            out += [sb.extract(), sb.extract()]
+            out = [i for i in out if i is not None]
+            assert sorted(items) == sorted(out), (items, out)
+            sb.close()
+        finally:
+            shutil.rmtree(path)
+    def test_many_matches_single(self):
+        items=[bytes([x,x,x]) for x in range(50)]
+        single = ShuffleBuffer(elem_size=3, elem_count=4, seed=1)
+        out=[single.insert_or_replace(i) for i in items]
+        many = ShuffleBuffer(elem_size=3, elem_count=4, seed=1)
+        r = many.insert_or_replace_many(b''.join(items))
+        assert [x.tobytes() for x in r] == [x for x in out if x is not None]
+    def test_save_load(self):
+        items=np.array([[x, x, x] for x in range(8)], dtype=np.uint8)
+        sb = ShuffleBuffer(elem_size=3, elem_count=10)
+        sb.insert_or_replace_many(items)
+        with tempfile.NamedTemporaryFile() as f:
+            sb.save(f.name)
+            assert os.path.getsize(f.name) == 8 * 3
+            restored = ShuffleBuffer(elem_size=3, elem_count=10)
+            assert restored.load(f.name) == 8
+        assert sorted(restored.extract_many(10).tolist()) == items.tolist()
+    def test_min_fill(self):
+        n=1000 # number of test items.
+        items=np.array([[x % 256, x // 256, 0] for x in range(n)], dtype=np.uint8)
+        sb = ShuffleBuffer(elem_size=3, elem_count=100, min_fill=10)
+        out=[]
+        for i in range(0, n, 10):
+            r = sb.insert_or_replace_many(items[i:i+10])
+            # Items are returned before the buffer is full, but not before
+            # it holds 'min_fill' items.
+            if len(r) and len(out) == 0:
+                assert 10 <= sb.used + len(r) < 100, sb.used
+            out += r.tolist()
+        # The buffer still fills up, and returns everything eventually.
+        assert sb.used == 100, sb.used
+        out += sb.extract_many(100).tolist()
+        assert sorted(items.tolist()) == sorted(out)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+#
+#    This file is part of Leela Chess.
+#
+#    Leela Chess is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Leela Chess is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Leela Chess.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+import unittest
+
+class ShuffleStats:
+    def __init__(self, batch_size, horizon):
+        """
+            Measures how well a shuffle buffer decorrelates the records it
+            yields, from the source chunk of every record in yield order.
+
+            Records are grouped into batches of 'batch_size' records as they
+            are yielded. Chunks not seen for 'horizon' records are forgotten
+            at every report().
+        """
+        self.batch_size = batch_size
+        self.horizon = horizon
+        # Chunks of the records of the batch being filled.
+        self.pending = np.zeros(0, dtype=np.uint64)
+        # Yield index of the last record seen of every chunk.
+        self.last = {}
+        # Number of records seen so far.
+        self.seen = 0
+        self.reset()
+
+    def reset(self):
+        self.batches = 0
+        self.same_pairs = 0.0
+        self.distinct = 0
+        self.sibling_count = 0
+        self.sibling_sum = 0
+
+    def add(self, chunks):
+        """
+            Account for yielded records coming from the chunks in the 1-D
+            array 'chunks', in yield order.
+        """
+        last = self.last
+        for i, chunk in enumerate(chunks.tolist(), self.seen):
+            prev = last.get(chunk)
+            if prev is not None:
+                self.sibling_count += 1
+                self.sibling_sum += i - prev
+            last[chunk] = i
+        self.seen += len(chunks)
+
+        pending = np.concatenate([self.pending, chunks])
+        n = len(pending) // self.batch_size * self.batch_size
+        if n and self.batch_size > 1:
+            pairs = self.batch_size * (self.batch_size - 1) / 2
+            for batch in pending[:n].reshape(-1, self.batch_size):
+                _, counts = np.unique(batch, return_counts=True)
+                self.same_pairs += (counts * (counts - 1) / 2).sum() / pairs
+                self.distinct += len(counts)
+                self.batches += 1
+        self.pending = pending[n:]
+
+    def report(self):
+        """
+            Return the averages since the last report, and start over.
+
+            'same_chunk_pairs' is the fraction of the pairs of records in a
+            batch that come from the same chunk.
+            'chunks_per_batch' is the number of distinct chunks, that is
+            games, in a batch.
+            'sibling_distance' is the number of records yielded between two
+            records of the same chunk.
+        """
+        stats = {
+            'same_chunk_pairs': float(self.same_pairs) / max(1, self.batches),
+            'chunks_per_batch': self.distinct / max(1, self.batches),
+            'sibling_distance': self.sibling_sum / max(1, self.sibling_count),
+        }
+        self.reset()
+        oldest = self.seen - self.horizon
+        self.last = {k: v for k, v in self.last.items() if v >= oldest}
+        return stats
+
+
+class ShuffleStatsTest(unittest.TestCase):
+    def test_unshuffled(self):
+        stats = ShuffleStats(batch_size=4, horizon=100)
+        # Two chunks of 4 records each, in order.
+        stats.add(np.array([1, 1, 1, 1, 2, 2, 2, 2], dtype=np.uint64))
+        r = stats.report()
+        assert r['same_chunk_pairs'] == 1.0, r
+        assert r['chunks_per_batch'] == 1.0, r
+        assert r['sibling_distance'] == 1.0, r
+    def test_interleaved(self):
+        stats = ShuffleStats(batch_size=4, horizon=100)
+        # Records yielded in blocks which don't line up with the batches.
+        stats.add(np.array([1, 2, 3], dtype=np.uint64))
+        stats.add(np.array([4, 1, 2, 3, 4, 5], dtype=np.uint64))
+        r = stats.report()
+        assert r['same_chunk_pairs'] == 0.0, r
+        assert r['chunks_per_batch'] == 4.0, r
+        assert r['sibling_distance'] == 4.0, r
+    def test_horizon(self):
+        stats = ShuffleStats(batch_size=1, horizon=2)
+        stats.add(np.array([1, 2, 3, 4], dtype=np.uint64))
+        stats.report()
+        # Chunk 1 was forgotten, so yielding it again isn't a sibling.
+        stats.add(np.array([1, 4], dtype=np.uint64))
+        r = stats.report()
+        assert r['sibling_distance'] == 2.0, r
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -56,6 +56,12 @@ class TFProcess:
         # For exporting
         self.weights = []
 
+        # Called with the path of every checkpoint saved.
+        self.checkpoint_callbacks = []
+        # Called at every training report for a dict of extra values to
+        # print and summarize.
+        self.report_sources = []
+
         gpu_options = tf.GPUOptions(per_process_gpu_memory_fraction=0.90, allow_growth=True, visible_device_list="{}".format(self.cfg['gpu']))
         config = tf.ConfigProto(gpu_options=gpu_options)
         self.session = tf.Session(config=config)
@@ -261,6 +267,12 @@ class TFProcess:
                 tf.Summary.Value(tag="Reg term", simple_value=avg_reg_term),
                 tf.Summary.Value(tag="LR", simple_value=self.lr),
                 tf.Summary.Value(tag="MSE Loss", simple_value=avg_mse_loss)])
+            for source in self.report_sources:
+                values = source()
+                if values:
+                    print(" ".join("{}={:g}".format(k, v) for k, v in sorted(values.items())))
+                for k, v in sorted(values.items()):
+                    train_summaries.value.add(tag=k, simple_value=v)
             self.train_writer.add_summary(train_summaries, steps)
             self.time_start = time_end
             self.last_steps = steps
@@ -277,6 +289,8 @@ class TFProcess:
             path = os.path.join(self.root_dir, self.cfg['name'])
             save_path = self.saver.save(self.session, path, global_step=steps)
             print("Model saved in file: {}".format(save_path))
+            for callback in self.checkpoint_callbacks:
+                callback(save_path)
             leela_path = path + "-" + str(steps) + ".txt"
             self.save_leelaz_weights(leela_path) 
             print("Weights saved in file: {}".format(leela_path))
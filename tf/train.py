@@ -21,12 +21,15 @@ import os
 import yaml
 import sys
 import glob
-import gzip
 import random
 import multiprocessing as mp
-import tensorflow as tf
-from tfprocess import TFProcess
+import chunkcodec
+import gzindex
 from chunkparser import ChunkParser
+from datasrc import FileDataSrc
+from chunkshards import ChunkShardDataSrc
+from workerpool import WorkerPool
+import fixedrecords
 
 SKIP = 32
 
@@ -38,7 +41,10 @@ def get_checkpoint(root_dir):
 
 
 def get_chunks(data_prefix):
-    return glob.glob(data_prefix + "*.gz")
+    chunks = []
+    for ext in chunkcodec.EXTENSIONS:
+        chunks += glob.glob(data_prefix + "*" + ext)
+    return chunks
 
 
 def get_latest_chunks(path, num_chunks):
@@ -59,79 +65,178 @@ def get_latest_chunks(path, num_chunks):
     return chunks
 
 
-class FileDataSrc:
+def count_records(chunks):
     """
-        data source yielding chunkdata from chunk files.
+        Return the number of records in 'chunks' from their gzip indexes,
+        without opening the chunks, or None unless they're all indexed.
     """
-    def __init__(self, chunks):
-        self.chunks = []
-        self.done = chunks
-    def next(self):
-        if not self.chunks:
-            self.chunks, self.done = self.done, self.chunks
-            random.shuffle(self.chunks)
-        if not self.chunks:
+    total = 0
+    for chunk in chunks:
+        count = gzindex.record_count(chunk)
+        if count is None:
             return None
-        while len(self.chunks):
-            filename = self.chunks.pop()
-            try:
-                with gzip.open(filename, 'rb') as chunk_file:
-                    self.done.append(filename)
-                    return chunk_file.read()
-            except:
-                print("failed to parse {}".format(filename))
+        total += count
+    return total
+
+
+def remove_stale_state(root_dir, checkpoints):
+    """
+        Remove the input pipeline state saved with the checkpoints in
+        'root_dir' that aren't among 'checkpoints' anymore, as the saver
+        deleted them.
+    """
+    keep = set(os.path.abspath(cp) for cp in checkpoints)
+    for suffix in ('.train.json', '.train.shuffle', '.test.json', '.test.shuffle'):
+        for filename in glob.glob(os.path.join(root_dir, '*' + suffix)):
+            if os.path.abspath(filename[:-len(suffix)]) not in keep:
+                os.remove(filename)
 
 
 def main(cmd):
+    # Spawned workers import this module too, but need no TensorFlow.
+    import tensorflow as tf
+    from tfprocess import TFProcess
+
     cfg = yaml.safe_load(cmd.cfg.read())
     print(yaml.dump(cfg, default_flow_style=False))
 
+    if 'fixed_records_train' in cfg['dataset']:
+        return main_fixed_records(cmd, cfg)
+
     num_chunks = cfg['dataset']['num_chunks']
     train_ratio = cfg['dataset']['train_ratio']
     num_train = int(num_chunks*train_ratio)
     num_test = num_chunks - num_train
-    if 'input_test' in cfg['dataset']:
-        train_chunks = get_latest_chunks(cfg['dataset']['input_train'], num_train)
-        test_chunks = get_latest_chunks(cfg['dataset']['input_test'], num_test)
+    if 'chunk_shards_train' in cfg['dataset']:
+        # Every game of the chunk shards counts as a chunk.
+        train_src = ChunkShardDataSrc(sorted(glob.glob(cfg['dataset']['chunk_shards_train'])))
+        test_src = ChunkShardDataSrc(sorted(glob.glob(cfg['dataset']['chunk_shards_test'])))
+        num_test = len(test_src.chunks)
+    elif 'input_test' in cfg['dataset']:
+        train_src = FileDataSrc(get_latest_chunks(cfg['dataset']['input_train'], num_train))
+        test_src = FileDataSrc(get_latest_chunks(cfg['dataset']['input_test'], num_test))
     else:
         chunks = get_latest_chunks(cfg['dataset']['input'], num_chunks)
-        train_chunks = chunks[:num_train]
-        test_chunks = chunks[num_train:]
+        train_src = FileDataSrc(chunks[:num_train])
+        test_src = FileDataSrc(chunks[num_train:])
 
     shuffle_size = cfg['training']['shuffle_size']
     ChunkParser.BATCH_SIZE = cfg['training']['batch_size']
+    # Input pipeline settings shared by the train and test parsers.
+    parser_args = {
+        'sample': SKIP,
+        'batch_size': ChunkParser.BATCH_SIZE,
+        'frame_records': cfg['training'].get('frame_records', 1),
+        'frame_bytes': cfg['training'].get('frame_bytes', None),
+        'transport': cfg['training'].get('transport', 'pipe'),
+        'ring_slots': cfg['training'].get('ring_slots', 64),
+        'worker_batches': cfg['training'].get('worker_batches', False),
+        'packed_planes': cfg['training'].get('packed_planes', False),
+        'shuffle_dir': cfg['training'].get('shuffle_dir', None),
+        'compact_records': cfg['training'].get('compact_records', False),
+        'policy_slots': cfg['training'].get('policy_slots', 64),
+        'shuffle_warmup': cfg['training'].get('shuffle_warmup', None),
+        'worker_shuffle_size': cfg['training'].get('worker_shuffle_size', None),
+        'batch_arrays': cfg['training'].get('batch_arrays', False),
+        'pipeline_stages': cfg['training'].get('pipeline_stages', False),
+    }
+    # Split the memory budget between the batches tf.data prefetches for
+    # each parser, up to 4, and the messages queued by the pool, along with
+    # its rings with the 'shm' transport.
+    budget = cfg['training'].get('inflight_bytes', None)
+    prefetch = 4
+    if budget is not None:
+        batch_bytes = ChunkParser.batch_bytes(ChunkParser.BATCH_SIZE)
+        prefetch = max(1, min(prefetch, budget // 4 // batch_bytes))
+        budget = max(0, budget - 2 * prefetch * batch_bytes)
+        print("Prefetching {} batches of {} bytes".format(prefetch, batch_bytes))
+    # Batches tf.data prefetches, runs and is handing over stay unchanged.
+    parser_args['batch_slots'] = prefetch + 3
+    # One pool of workers produces for both the train and test parsers.
+    pool = WorkerPool(cfg['training'].get('workers', None),
+            transport=parser_args['transport'], ring_slots=parser_args['ring_slots'],
+            credits=cfg['training'].get('stream_credits', None),
+            max_restarts=cfg['training'].get('max_restarts', 100),
+            min_workers=cfg['training'].get('min_workers', None),
+            max_workers=cfg['training'].get('max_workers', None),
+            scale_interval=cfg['training'].get('scale_interval', 10.0),
+            budget=budget)
+    parser_args['pool'] = pool
+    if parser_args['packed_planes']:
+        parse_function = ChunkParser.parse_function_packed
+    else:
+        parse_function = ChunkParser.parse_function
+
+    def make_dataset(parser):
+        if parser_args['batch_arrays']:
+            # The batches are tensors already.
+            batch_size = ChunkParser.BATCH_SIZE
+            dataset = tf.data.Dataset.from_generator(
+                parser.parse, output_types=(tf.float32, tf.float32, tf.float32),
+                output_shapes=((batch_size, 112, 8*8), (batch_size, 1858), (batch_size, 1)))
+        else:
+            dataset = tf.data.Dataset.from_generator(
+                parser.parse, output_types=(tf.string, tf.string, tf.string))
+            dataset = dataset.map(parse_function)
+        return dataset.prefetch(prefetch)
 
     root_dir = os.path.join(cfg['training']['path'], cfg['name'])
     if not os.path.exists(root_dir):
         os.makedirs(root_dir)
 
-    train_parser = ChunkParser(FileDataSrc(train_chunks),
-            shuffle_size=shuffle_size, sample=SKIP, batch_size=ChunkParser.BATCH_SIZE)
-    dataset = tf.data.Dataset.from_generator(
-        train_parser.parse, output_types=(tf.string, tf.string, tf.string))
-    dataset = dataset.map(ChunkParser.parse_function)
-    dataset = dataset.prefetch(4)
+    cp = None
+    if os.path.exists(os.path.join(root_dir, 'checkpoint')):
+        cp = get_checkpoint(root_dir)
+    # Resume the input pipelines from the state saved with the checkpoint.
+    save_pipeline_state = cfg['training'].get('save_pipeline_state', False)
+    train_state, test_state = None, None
+    if save_pipeline_state and cp:
+        train_state, test_state = cp + '.train', cp + '.test'
+
+    # Only the train parser's shuffle quality is reported.
+    shuffle_stats = cfg['training'].get('shuffle_stats', False)
+    train_parser = ChunkParser(train_src,
+            shuffle_size=shuffle_size, state=train_state,
+            shuffle_stats=shuffle_stats, **parser_args)
+    dataset = make_dataset(train_parser)
     train_iterator = dataset.make_one_shot_iterator()
 
     shuffle_size = int(shuffle_size*(1.0-train_ratio))
-    test_parser = ChunkParser(FileDataSrc(test_chunks),
-            shuffle_size=shuffle_size, sample=SKIP, batch_size=ChunkParser.BATCH_SIZE)
-    dataset = tf.data.Dataset.from_generator(
-        test_parser.parse, output_types=(tf.string, tf.string, tf.string))
-    dataset = dataset.map(ChunkParser.parse_function)
-    dataset = dataset.prefetch(4)
+    test_parser = ChunkParser(test_src,
+            shuffle_size=shuffle_size, state=test_state,
+            weight=cfg['training'].get('test_weight', 0.25), **parser_args)
+    pool.start()
+    dataset = make_dataset(test_parser)
     test_iterator = dataset.make_one_shot_iterator()
 
     tfprocess = TFProcess(cfg)
     tfprocess.init(dataset, train_iterator, test_iterator)
+    if save_pipeline_state:
+        def save_state(path):
+            train_parser.save_state(path + '.train')
+            test_parser.save_state(path + '.test')
+            remove_stale_state(root_dir, tfprocess.saver.last_checkpoints)
+        tfprocess.checkpoint_callbacks.append(save_state)
+    if shuffle_stats:
+        tfprocess.report_sources.append(train_parser.shuffle_quality)
+    tfprocess.report_sources.append(train_parser.pipeline_report)
+    tfprocess.report_sources.append(pool.memory_report)
+    if parser_args['pipeline_stages']:
+        tfprocess.report_sources.append(train_parser.stage_report)
 
-    if os.path.exists(os.path.join(root_dir, 'checkpoint')):
-        cp = get_checkpoint(root_dir)
+    if cp:
         tfprocess.restore(cp)
+        # A new saver knows of no checkpoints, and would take the state of
+        # those of earlier runs for stale.
+        checkpoints = tf.train.get_checkpoint_state(root_dir).all_model_checkpoint_paths
+        tfprocess.saver.recover_last_checkpoints(checkpoints)
 
     # Sweeps through all test chunks statistically
-	# Assumes average of 10 samples per test game.
+	# Assumes average of 10 samples per test game, unless they're indexed.
     num_evals = num_test*10 // ChunkParser.BATCH_SIZE
+    test_records = count_records(test_src.chunks)
+    if test_records is not None:
+        num_evals = max(1, test_records // SKIP // ChunkParser.BATCH_SIZE)
     print("Using {} evaluation batches".format(num_evals))
 
     tfprocess.process_loop(ChunkParser.BATCH_SIZE, num_evals)
@@ -139,9 +244,58 @@ def main(cmd):
     tfprocess.save_leelaz_weights(cmd.output)
 
     tfprocess.session.close()
+    pool.shutdown()
     train_parser.shutdown()
     test_parser.shutdown()
 
+def main_fixed_records(cmd, cfg):
+    """
+        Train from record files written by fixedrecords.py, read and decoded
+        by tf.data alone, without parsers or workers.
+    """
+    import tensorflow as tf
+    from tfprocess import TFProcess
+
+    train_files = glob.glob(cfg['dataset']['fixed_records_train'])
+    test_files = glob.glob(cfg['dataset']['fixed_records_test'])
+    if not train_files or not test_files:
+        print("No record files {} {}".format(len(train_files), len(test_files)))
+        sys.exit(1)
+    num_test = fixedrecords.total_records(test_files)
+    print("{} train and {} test records in {} record files".format(
+        fixedrecords.total_records(train_files), num_test, len(train_files) + len(test_files)))
+
+    shuffle_size = cfg['training']['shuffle_size']
+    train_ratio = cfg['dataset']['train_ratio']
+    ChunkParser.BATCH_SIZE = cfg['training']['batch_size']
+    sample = cfg['dataset'].get('fixed_records_sample', 1)
+    readers = cfg['training'].get('fixed_records_readers', 8)
+    dataset = fixedrecords.record_dataset(train_files, ChunkParser.BATCH_SIZE,
+            shuffle_size, sample=sample, readers=readers)
+    train_iterator = dataset.make_one_shot_iterator()
+    dataset = fixedrecords.record_dataset(test_files, ChunkParser.BATCH_SIZE,
+            int(shuffle_size*(1.0-train_ratio)), sample=sample, readers=readers)
+    test_iterator = dataset.make_one_shot_iterator()
+
+    root_dir = os.path.join(cfg['training']['path'], cfg['name'])
+    if not os.path.exists(root_dir):
+        os.makedirs(root_dir)
+
+    tfprocess = TFProcess(cfg)
+    tfprocess.init(dataset, train_iterator, test_iterator)
+    if os.path.exists(os.path.join(root_dir, 'checkpoint')):
+        tfprocess.restore(get_checkpoint(root_dir))
+
+    # Sweeps through the sampled test records once.
+    num_evals = max(1, num_test // sample // ChunkParser.BATCH_SIZE)
+    print("Using {} evaluation batches".format(num_evals))
+
+    tfprocess.process_loop(ChunkParser.BATCH_SIZE, num_evals)
+
+    tfprocess.save_leelaz_weights(cmd.output)
+
+    tfprocess.session.close()
+
 if __name__ == "__main__":
     argparser = argparse.ArgumentParser(description=\
     'Tensorflow pipeline for training Leela Chess.')
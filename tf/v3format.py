@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+#
+#    This file is part of Leela Chess.
+#
+#    Leela Chess is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Leela Chess is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Leela Chess.  If not, see <http://www.gnu.org/licenses/>.
+
+import gzip
+import numpy as np
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+# The layout of a v3 record, see ChunkParser.init_structs().
+VERSION = struct.pack('i', 3)
+STRUCT_STRING = '4s7432s832sBBBBBBBb'
+# Size in bytes of a v3 record.
+V3_BYTES = struct.calcsize(STRUCT_STRING)
+# Byte ranges of the fields of a v3 record.
+PROBS = slice(4, 7436)
+PLANES = slice(7436, 8268)
+SCALARS = slice(8268, 8276)
+# The same layout as STRUCT_STRING, for decoding many records at once.
+V3_DTYPE = np.dtype([
+    ('version', np.uint8, (4,)),
+    ('probs', np.uint8, (7432,)),
+    ('planes', np.uint8, (832,)),
+    ('us_ooo', np.uint8),
+    ('us_oo', np.uint8),
+    ('them_ooo', np.uint8),
+    ('them_oo', np.uint8),
+    ('stm', np.uint8),
+    ('rule50_count', np.uint8),
+    ('move_count', np.uint8),
+    ('winner', np.int8)])
+
+
+def synthetic_chunk(rng, records=100):
+    """
+        Return the chunkdata of a made up game of 'records' v3 records,
+        shaped like real ones: around 30 non-zero policy entries, bit planes
+        of 8 positions of a game in which one piece moves per ply, and the
+        scalar bytes.
+    """
+    # Bitboards of the 12 pieces, from the starting position.
+    board = np.array([0xff00, 0x42, 0x24, 0x81, 0x8, 0x10,
+                      0xff << 48, 0x42 << 56, 0x24 << 56, 0x81 << 56, 0x8 << 56, 0x10 << 56],
+                     dtype=np.uint64)
+    history = [board.copy() for _ in range(8)]
+    out = np.zeros((records, V3_BYTES), dtype=np.uint8)
+    out[:, :4] = np.frombuffer(VERSION, dtype=np.uint8)
+    for i in range(records):
+        policy = out[i, PROBS].view(np.float32)
+        moves = rng.choice(1858, size=rng.integers(20, 40), replace=False)
+        policy[moves] = rng.dirichlet(np.full(len(moves), 0.3)).astype(np.float32)
+        planes = out[i, PLANES].view(np.uint64).reshape(8, 13)
+        for h, position in enumerate(history):
+            planes[h, :12] = position
+        # Move a piece of the side to move to a random square.
+        piece = rng.integers(6) + 6 * (i % 2)
+        squares = np.flatnonzero(np.unpackbits(board[piece:piece + 1].view(np.uint8)))
+        if len(squares):
+            board[piece] ^= np.uint64(1) << np.uint64(rng.choice(squares) ^ 7)
+            board[piece] |= np.uint64(1) << np.uint64(rng.integers(64))
+        history = [board.copy()] + history[:-1]
+        scalars = out[i, SCALARS]
+        scalars[:4] = 1
+        scalars[4] = i % 2
+        scalars[5] = i % 50
+        scalars[7] = rng.integers(-1, 2).astype(np.int8).view(np.uint8)
+    return out.tobytes()
+
+
+def write_chunks(dirname, games):
+    """
+        Write the chunkdata of 'games' to the gzipped chunks training.0.gz
+        and on in 'dirname', and return their filenames.
+    """
+    filenames = []
+    for i, data in enumerate(games):
+        filenames.append(os.path.join(dirname, 'training.{}.gz'.format(i)))
+        with gzip.open(filenames[-1], 'wb') as f:
+            f.write(data)
+    return filenames
+
+
+class ChunkTestCase(unittest.TestCase):
+    """
+        Tests of chunks written by write_chunks() to a temporary directory,
+        with a seeded 'rng' to make them up.
+    """
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.rng = np.random.default_rng(0)
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+    def write_chunks(self, games):
+        return write_chunks(self.dir, games)
+
+
+class V3FormatTest(unittest.TestCase):
+    def test_layout(self):
+        assert V3_BYTES == V3_DTYPE.itemsize == 8276, V3_BYTES
+        assert (PROBS.start, PLANES.start, SCALARS.start, SCALARS.stop) == \
+            (V3_DTYPE.fields['probs'][1], V3_DTYPE.fields['planes'][1],
+             V3_DTYPE.fields['us_ooo'][1], V3_BYTES)
+    def test_synthetic(self):
+        data = synthetic_chunk(np.random.default_rng(0), 30)
+        assert len(data) == 30 * V3_BYTES
+        records = np.frombuffer(data, dtype=np.uint8).reshape(-1, V3_BYTES)
+        policy = records[:, PROBS].copy().view(np.float32)
+        assert np.allclose(policy.sum(axis=1), 1, atol=1e-4)
+        # Consecutive records share most of their history planes.
+        planes = records[:, PLANES]
+        assert (planes[1:, 104:] == planes[:-1, :-104]).all()
+
+
+if __name__ == '__main__':
+    unittest.main()
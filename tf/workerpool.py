@@ -0,0 +1,631 @@
+#!/usr/bin/env python3
+#
+#    This file is part of Leela Chess.
+#
+#    Leela Chess is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Leela Chess is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Leela Chess.  If not, see <http://www.gnu.org/licenses/>.
+
+import itertools
+import multiprocessing as mp
+import os
+import queue
+import shmring
+import struct
+import threading
+import time
+import unittest
+
+# Message header: stream index, number of messages following, 0 for EOF.
+HEADER = struct.Struct('<BB')
+
+class WorkerPool:
+    def __init__(self, workers=None, transport='pipe', ring_slots=64, credits=None, max_restarts=100,
+            min_workers=None, max_workers=None, scale_interval=10.0, budget=None):
+        """
+            A pool of worker processes shared by several streams, such as
+            the train and test parsers.
+
+            Every stream has a producer with a worker_gen(chunkdatasrc)
+            method yielding lists of messages, message_size() and
+            message_list_size() methods giving the largest message and list
+            of messages in bytes, and a weight. Each worker runs
+            a generator per stream, and produces for the stream with the
+            lowest weighted share of its work so far among the streams with
+            credit left. A stream starts out with 'credits' credits, and gets
+            one back for every list of messages it reads, so a stream nobody
+            reads from, like the test stream between evaluations, takes no
+            worker time once its credits are used up.
+
+            Workers that die are replaced by new ones, up to 'max_restarts'
+            times. All the streams must be added before start() is called.
+
+            If 'min_workers' or 'max_workers' is set, the pool checks every
+            'scale_interval' seconds how long the readers of the streams
+            waited for messages and how full their queues are, and adds a
+            worker when the readers wait, or retires one when the queues
+            stay full, within those bounds. 'workers' is then the number of
+            workers to start with.
+
+            If 'budget' is set, it's the number of bytes of messages the
+            streams may have in flight together, between being produced and
+            being read. It's split evenly between the streams, and gives
+            their credits instead of 'credits'.
+
+            With the 'shm' transport every worker has a ring of 'ring_slots'
+            messages, which ends up resident in full, but never more slots
+            than the lists of messages the streams have credit for. With
+            'budget', the rings count against it, each with just the slots
+            of one list of messages.
+        """
+        if workers is None:
+            # Leave 2 for TensorFlow.
+            workers = max(1, mp.cpu_count() - 2)
+        assert transport in ('pipe', 'shm'), transport
+        self.autoscale = min_workers is not None or max_workers is not None
+        if min_workers is None:
+            min_workers = 1
+        if max_workers is None:
+            max_workers = max(workers, mp.cpu_count())
+        assert 0 < min_workers <= max_workers, (min_workers, max_workers)
+        if self.autoscale:
+            workers = min(max(workers, min_workers), max_workers)
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.scale_interval = scale_interval
+        # Number of workers running, changed by autoscaling.
+        self.workers = workers
+        self.transport = transport
+        self.ring_slots = ring_slots
+        if credits is None:
+            credits = 2 * (max_workers if self.autoscale else workers)
+        self.credits = credits
+        self.budget = budget
+        # Credits of every stream.
+        self.stream_credits = []
+        self.max_restarts = max_restarts
+        self.streams = []
+        self.queues = []
+        self.processes = []
+        self.readers = []
+        # Worker index of every reader.
+        self.reader_worker = {}
+        # Stream each worker holds a credit of, or -1.
+        self.holding = []
+        # Set to make a worker finish and exit.
+        self.stops = []
+        # Indices of the workers that weren't retired.
+        self.active = set()
+        # Indices of the workers done with every stream.
+        self.eofs = []
+        # Stream counters at the last autoscaling check.
+        self.last_scale = None
+        # Bytes of messages queued for the readers, and their time integral
+        # and peak since the last memory_report().
+        self.queued_lock = threading.Lock()
+        self.queued = 0
+        self.queued_since = None
+        self.queued_integral = 0.0
+        self.queued_peak = 0
+        self.report_since = None
+        self.reader_thread = None
+        self.running = False
+        # Pool counters, see get_stats().
+        self.stats = {
+            'stream_messages': [],
+            'stream_wait_time': [],
+            'restarts': 0,
+            'worker_messages': [],
+            'hol_skips': 0,
+            'scale_ups': 0,
+            'scale_downs': 0,
+            'peak_queued_bytes': 0,
+        }
+
+    def add_stream(self, producer, chunkdatasrc, weight=1.0):
+        """
+            Add a stream produced by 'producer' from 'chunkdatasrc', and
+            return its index.
+        """
+        assert not self.processes, "streams must be added before start()"
+        assert weight > 0, weight
+        self.streams.append((producer, chunkdatasrc, weight, None))
+        self.queues.append(queue.Queue())
+        self.stats['stream_messages'].append(0)
+        self.stats['stream_wait_time'].append(0.0)
+        return len(self.streams) - 1
+
+    def start(self):
+        """
+            Start the worker processes.
+        """
+        producers = [p for p, _, _, _ in self.streams]
+        budget = self.budget
+        if self.transport == 'shm':
+            self.slot_size = max(p.message_size() for p in producers)
+            # A header and the messages of the largest list.
+            list_slots = 1 + max(-(-p.message_list_size() // self.slot_size) for p in producers)
+            if budget is not None:
+                self.ring_slots = list_slots
+                workers = self.max_workers if self.autoscale else self.workers
+                rings = workers * list_slots * self.slot_size
+                print("Rings of {} bytes for {} workers".format(rings, workers))
+                budget = max(0, budget - rings)
+        for producer in producers:
+            credits = self.credits
+            if budget is not None:
+                share = budget // len(self.streams)
+                credits = max(1, share // producer.message_list_size())
+                print("Stream of {} credits of {} bytes".format(credits, producer.message_list_size()))
+            self.stream_credits.append(credits)
+        if self.transport == 'shm':
+            self.ring_slots = min(self.ring_slots, sum(self.stream_credits) * list_slots)
+        self.streams = [(p, c, w, mp.Semaphore(n)) for (p, c, w, _), n in zip(self.streams, self.stream_credits)]
+        self.eofs = [set() for _ in self.streams]
+        self.queued_since = self.report_since = time.time()
+        for i in range(self.workers):
+            self.start_worker(i)
+        self.running = True
+        self.reader_thread = threading.Thread(target=self.read_loop, daemon=True)
+        self.reader_thread.start()
+
+    def start_worker(self, i):
+        """
+            Start worker 'i', or a replacement for it, which produces every
+            stream from the start again.
+        """
+        if self.transport == 'shm':
+            assert shmring.shared_memory is not None, "the 'shm' transport needs Python 3.8+"
+            read, write = shmring.Pipe(self.slot_size, self.ring_slots)
+        else:
+            read, write = mp.Pipe(duplex=False)
+        holding = mp.Value('i', -1)
+        stop = mp.Value('b', 0)
+        p = mp.Process(target=_work, args=(self.streams, write, holding, stop))
+        p.start()
+        if self.transport == 'pipe':
+            # The worker has its own copy, so it alone decides on EOF.
+            write.close()
+        else:
+            # A ring gets no EOF from a worker that dies, even halfway
+            # through a list of messages.
+            read.watch(p)
+        if i < len(self.processes):
+            self.processes[i] = p
+            self.holding[i] = holding
+            self.stops[i] = stop
+        else:
+            self.processes.append(p)
+            self.holding.append(holding)
+            self.stops.append(stop)
+            self.stats['worker_messages'].append(0)
+        self.active.add(i)
+        for eofs in self.eofs:
+            eofs.discard(i)
+        self.readers.append(read)
+        self.reader_worker[read] = i
+
+    def worker_exit(self, r):
+        """
+            Handle EOF from reader 'r', replacing its worker if it died.
+        """
+        self.readers.remove(r)
+        r.close()
+        i = self.reader_worker.pop(r)
+        p = self.processes[i]
+        p.join(1.0)
+        if p.exitcode in (0, None) or not self.running:
+            return
+        # Give back the credit the worker took for a message it never sent.
+        stream = self.holding[i].value
+        if stream >= 0:
+            self.streams[stream][3].release()
+        if self.stats['restarts'] >= self.max_restarts:
+            print("Worker {} died with exit code {}, not restarting".format(i, p.exitcode))
+            return
+        print("Worker {} died with exit code {}, restarting".format(i, p.exitcode))
+        self.stats['restarts'] += 1
+        self.start_worker(i)
+
+    def scale(self):
+        """
+            Add or retire a worker if the readers of the streams read since
+            the last check wait for messages, or leave them queued.
+        """
+        now = time.time()
+        counters = (now, list(self.stats['stream_messages']), list(self.stats['stream_wait_time']))
+        if self.last_scale is None:
+            self.last_scale = counters
+            return
+        last, messages, wait_time = self.last_scale
+        if now - last < self.scale_interval:
+            return
+        self.last_scale = counters
+        read = [i for i in range(len(self.streams)) if counters[1][i] > messages[i]]
+        if not read:
+            return  # nobody is reading, so there's no demand to go by
+        # Worst case over the streams being read.
+        # Waits are counted when they end, so one can span two checks.
+        wait = min(1.0, max(counters[2][i] - wait_time[i] for i in read) / (now - last))
+        depth = min(self.queues[i].qsize() / self.stream_credits[i] for i in read)
+        if wait > 0.1 and self.workers < self.max_workers:
+            self.stats['scale_ups'] += 1
+            # Reuse the slot of a retired worker that has exited.
+            reading = set(self.reader_worker.values())
+            free = [i for i in range(len(self.processes)) if i not in self.active and i not in reading]
+            self.start_worker(min(free) if free else len(self.processes))
+        elif wait < 0.01 and depth >= 0.5 and self.workers > self.min_workers:
+            self.stats['scale_downs'] += 1
+            i = max(self.active)
+            self.active.discard(i)
+            self.stops[i].value = 1
+        else:
+            return
+        print("Readers waited {:.0%} of the time with queues {:.0%} full, {} to {} workers".format(
+            wait, depth, 'growing' if len(self.active) > self.workers else 'shrinking',
+            len(self.active)))
+        self.workers = len(self.active)
+
+    def read_loop(self):
+        """
+            Move messages from the workers into the queues of their streams,
+            so a worker never blocks on a stream nobody reads from.
+        """
+        eofs = self.eofs
+        served = self.stats['worker_messages']
+        while self.readers and self.running:
+            ready = shmring.wait(self.readers, 0.1)
+            if not ready:
+                # Workers writing to a ring can die without EOF.
+                for r in list(self.readers):
+                    p = self.processes[self.reader_worker[r]]
+                    if not p.is_alive() and p.exitcode != 0 and not r.poll():
+                        self.worker_exit(r)
+            self.stats['hol_skips'] += len(self.readers) - len(ready)
+            # Least served first, so a slow worker with data isn't starved.
+            for r in sorted(ready, key=lambda r: served[self.reader_worker[r]]):
+                try:
+                    stream, count = HEADER.unpack(r.recv_bytes())
+                    messages = [r.recv_bytes() for _ in range(count)]
+                except (EOFError, OSError):
+                    self.worker_exit(r)
+                    continue
+                if count:
+                    served[self.reader_worker[r]] += 1
+                    self.account(sum(len(m) for m in messages))
+                    self.queues[stream].put(messages)
+                    continue
+                eofs[stream].add(self.reader_worker[r])
+                if self.active <= eofs[stream]:
+                    self.queues[stream].put(None)
+            if self.autoscale:
+                self.scale()
+        # Wake up the readers of the streams.
+        for q in self.queues:
+            q.put(None)
+
+    def stream_gen(self, stream):
+        """
+            Yield the lists of messages of 'stream', until every worker is
+            done with it.
+        """
+        q = self.queues[stream]
+        credits = self.streams[stream][3]
+        while True:
+            start = time.time()
+            messages = q.get()
+            self.stats['stream_wait_time'][stream] += time.time() - start
+            if messages is None:
+                q.put(None)
+                return
+            credits.release()
+            self.account(-sum(len(m) for m in messages))
+            self.stats['stream_messages'][stream] += 1
+            yield messages
+
+    def account(self, size):
+        """
+            Add 'size' bytes to the messages queued for the readers.
+        """
+        with self.queued_lock:
+            now = time.time()
+            self.queued_integral += self.queued * (now - self.queued_since)
+            self.queued_since = now
+            self.queued += size
+            self.queued_peak = max(self.queued_peak, self.queued)
+            self.stats['peak_queued_bytes'] = max(self.stats['peak_queued_bytes'], self.queued)
+
+    def memory_report(self):
+        """
+            Return the peak and time average of the bytes of messages queued
+            for the readers since the last report, in MiB, and start over.
+        """
+        with self.queued_lock:
+            now = time.time()
+            integral = self.queued_integral + self.queued * (now - self.queued_since)
+            report = {
+                'queued_mb_peak': self.queued_peak / 2**20,
+                'queued_mb_mean': integral / max(now - self.report_since, 1e-9) / 2**20,
+            }
+            self.queued_since = self.report_since = now
+            self.queued_integral = 0.0
+            self.queued_peak = self.queued
+        return report
+
+    def get_stats(self):
+        """
+            Return a snapshot of the pool counters.
+
+            'stream_messages' is the number of message lists read from each
+            stream.
+            'stream_wait_time' is the time in seconds the reader of each
+            stream was blocked waiting for a worker.
+            'restarts' is the number of workers replaced after dying.
+            'worker_messages' is the number of message lists read from each
+            worker.
+            'hol_skips' is the number of times a worker without data ready
+            was passed over in favour of one with data. Each of these would
+            have been a head-of-line stall with a fixed round-robin over the
+            workers.
+            'peak_queued_bytes' is the most bytes of messages ever queued
+            for the readers.
+            'scale_ups' and 'scale_downs' are the number of workers added
+            and retired by autoscaling.
+            'workers' is the number of workers running.
+        """
+        stats = dict(self.stats)
+        stats['workers'] = self.workers
+        stats['stream_messages'] = list(stats['stream_messages'])
+        stats['stream_wait_time'] = list(stats['stream_wait_time'])
+        stats['worker_messages'] = list(stats['worker_messages'])
+        return stats
+
+    def shutdown(self):
+        """
+            Stop the worker processes and release the pipes.
+        """
+        self.running = False
+        if self.reader_thread is not None:
+            self.reader_thread.join()
+        for p in self.processes:
+            p.terminate()
+            p.join()
+        for r in self.readers:
+            r.close()
+        self.processes = []
+        self.readers = []
+
+
+def _work(streams, writer, holding, stop):
+    """
+        Run in a worker process, producing messages for the streams with
+        credit, as fairly as their weights say. 'holding' tells the parent
+        which stream's credit the worker holds while producing. The worker
+        exits once 'stop' is set.
+    """
+    gens = [producer.worker_gen(chunkdatasrc) for producer, chunkdatasrc, _, _ in streams]
+    live = list(range(len(streams)))
+    # Virtual time of each stream, advancing by 1/weight per production.
+    passes = [0.0] * len(streams)
+    now = 0.0
+    while live and not stop.value:
+        for i in sorted(live, key=lambda i: passes[i]):
+            if streams[i][3].acquire(block=False):
+                holding.value = i
+                break
+        else:
+            time.sleep(0.005)  # no stream has credit
+            continue
+        try:
+            messages = next(gens[i])
+        except StopIteration:
+            streams[i][3].release()
+            holding.value = -1
+            live.remove(i)
+            writer.send_bytes(HEADER.pack(i, 0))
+            continue
+        writer.send_bytes(HEADER.pack(i, len(messages)))
+        for m in messages:
+            writer.send_bytes(m)
+        holding.value = -1
+        # A stream that was idle doesn't get to catch up on the others.
+        now = max(passes[i], now)
+        passes[i] = now + 1.0 / streams[i][2]
+    writer.close()
+
+
+class _Counter:
+    """
+        A producer yielding 'count' numbered messages, for testing.
+    """
+    def __init__(self, count):
+        self.count = count
+    def message_size(self):
+        return 8
+    def message_list_size(self):
+        return 8
+    def worker_gen(self, prefix):
+        for i in range(self.count):
+            yield [prefix + str(i).encode()]
+
+
+class _Crashing(_Counter):
+    """
+        A producer killing its worker halfway, the first time it's run.
+    """
+    def __init__(self, count):
+        super().__init__(count)
+        self.crashes = mp.Value('i', 1)
+    def worker_gen(self, prefix):
+        for i, messages in enumerate(super().worker_gen(prefix)):
+            if i == self.count // 2:
+                with self.crashes.get_lock():
+                    crash = self.crashes.value > 0
+                    self.crashes.value = 0
+                if crash:
+                    os._exit(1)
+            yield messages
+
+
+class _Cut(list):
+    """
+        A list of messages killing the worker sending it after the first.
+    """
+    def __iter__(self):
+        yield self[0]
+        os._exit(1)
+
+
+class _CrashingMidList(_Counter):
+    """
+        A producer killing its worker halfway through sending a list of
+        messages, halfway through the stream, the first time it's run.
+    """
+    def __init__(self, count):
+        super().__init__(count)
+        self.crashes = mp.Value('i', 1)
+    def worker_gen(self, prefix):
+        for i, messages in enumerate(super().worker_gen(prefix)):
+            messages = messages * 3
+            if i == self.count // 2:
+                with self.crashes.get_lock():
+                    crash = self.crashes.value > 0
+                    self.crashes.value = 0
+                if crash:
+                    messages = _Cut(messages)
+            yield messages
+
+
+class _Slow(_Counter):
+    """
+        A producer taking 'delay' seconds per message.
+    """
+    def __init__(self, count, delay):
+        super().__init__(count)
+        self.delay = delay
+    def worker_gen(self, prefix):
+        for messages in super().worker_gen(prefix):
+            time.sleep(self.delay)
+            yield messages
+
+
+class WorkerPoolTest(unittest.TestCase):
+    def test_streams(self):
+        pool = WorkerPool(workers=2)
+        a = pool.add_stream(_Counter(10), b'a')
+        b = pool.add_stream(_Counter(5), b'b')
+        pool.start()
+        out_a = [m for m, in pool.stream_gen(a)]
+        out_b = [m for m, in pool.stream_gen(b)]
+        pool.shutdown()
+        # Every worker produces the whole of every stream.
+        assert sorted(out_a) == sorted([b'a' + str(i).encode() for i in range(10)] * 2), out_a
+        assert sorted(out_b) == sorted([b'b' + str(i).encode() for i in range(5)] * 2), out_b
+    def test_restart(self):
+        for transport in ('pipe', 'shm'):
+            pool = WorkerPool(workers=1, transport=transport, credits=2)
+            a = pool.add_stream(_Crashing(10), b'a')
+            pool.start()
+            out = [m for m, in pool.stream_gen(a)]
+            pool.shutdown()
+            # The replacement starts over, after the first half got through.
+            assert sorted(out) == sorted([b'a' + str(i).encode() for i in list(range(5)) + list(range(10))]), out
+            assert pool.get_stats()['restarts'] == 1
+    def test_restart_mid_list(self):
+        for transport in ('pipe', 'shm'):
+            pool = WorkerPool(workers=1, transport=transport, credits=2)
+            a = pool.add_stream(_CrashingMidList(10), b'a')
+            pool.start()
+            out = [m for m, _, _ in pool.stream_gen(a)]
+            pool.shutdown()
+            # The list cut short is dropped, and the replacement starts over.
+            assert sorted(out) == sorted([b'a' + str(i).encode() for i in list(range(5)) + list(range(10))]), out
+            assert pool.get_stats()['restarts'] == 1
+    def test_credits(self):
+        pool = WorkerPool(workers=1, transport='shm', credits=3)
+        a = pool.add_stream(_Counter(100), b'a')
+        b = pool.add_stream(_Counter(100), b'b')
+        pool.start()
+        gen = pool.stream_gen(a)
+        out = [next(gen) for _ in range(50)]
+        time.sleep(0.1)
+        # Nobody read from 'b', so it got no more than its credits.
+        assert pool.queues[b].qsize() == 3, pool.queues[b].qsize()
+        assert len(out) == 50
+        pool.shutdown()
+    def test_budget(self):
+        pool = WorkerPool(workers=2, budget=48)
+        a = pool.add_stream(_Counter(100), b'a')
+        b = pool.add_stream(_Counter(100), b'b')
+        pool.start()
+        out = [m for m, in itertools.islice(pool.stream_gen(a), 50)]
+        time.sleep(0.2)
+        # Half the budget buys 'b' 3 messages of at most 8 bytes.
+        assert pool.queues[b].qsize() == 3, pool.queues[b].qsize()
+        report = pool.memory_report()
+        stats = pool.get_stats()
+        pool.shutdown()
+        assert len(out) == 50
+        assert 0 < stats['peak_queued_bytes'] <= 48, stats
+        assert 0 < report['queued_mb_mean'] <= report['queued_mb_peak'] <= 48 / 2**20, report
+    def test_ring_slots(self):
+        pool = WorkerPool(workers=1, transport='shm', credits=3)
+        a = pool.add_stream(_Counter(10), b'a')
+        pool.start()
+        out = [m for m, in pool.stream_gen(a)]
+        pool.shutdown()
+        # A header and a message for every credit.
+        assert pool.ring_slots == 6, pool.ring_slots
+        assert len(out) == 10
+        pool = WorkerPool(workers=2, transport='shm', budget=100)
+        a = pool.add_stream(_Counter(100), b'a')
+        b = pool.add_stream(_Counter(100), b'b')
+        pool.start()
+        out = [m for m, in itertools.islice(pool.stream_gen(a), 50)]
+        time.sleep(0.2)
+        # The rings take 2 slots of 8 bytes per worker, and 'b' gets 4
+        # messages of its half of the 68 bytes left.
+        assert pool.ring_slots == 2, pool.ring_slots
+        assert pool.queues[b].qsize() == 4, pool.queues[b].qsize()
+        pool.shutdown()
+        assert len(out) == 50
+    def test_autoscale(self):
+        pool = WorkerPool(workers=1, min_workers=1, max_workers=3, scale_interval=0.2, credits=4)
+        a = pool.add_stream(_Slow(10**6, 0.02), b'a')
+        pool.start()
+        gen = pool.stream_gen(a)
+        # Reading as fast as possible leaves the reader waiting on one worker.
+        start = time.time()
+        while time.time() - start < 1.5:
+            next(gen)
+        assert pool.get_stats()['workers'] == 3, pool.get_stats()
+        # Reading slowly leaves the queue full, even with a single worker.
+        start = time.time()
+        while time.time() - start < 2.0:
+            next(gen)
+            time.sleep(0.1)
+        stats = pool.get_stats()
+        assert stats['workers'] == 1, stats
+        assert stats['scale_ups'] == 2 and stats['scale_downs'] == 2, stats
+        # Growing again reuses the slots of the retired workers.
+        start = time.time()
+        while time.time() - start < 1.5:
+            next(gen)
+        stats = pool.get_stats()
+        slots = len(pool.processes)
+        pool.shutdown()
+        assert stats['workers'] == 3, stats
+        assert slots == 3 and len(stats['worker_messages']) == 3, (slots, stats)
+
+
+if __name__ == '__main__':
+    unittest.main()